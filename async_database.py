@@ -0,0 +1,179 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import export
+import key_import
+from database import Database
+
+
+class AsyncDatabase:
+    """Асинхронная обёртка над Database
+
+    Все запросы выполняются в отдельном пуле потоков, поэтому медленная
+    запись в SQLite или ожидание блокировки не останавливают event loop
+    и обработку апдейтов других пользователей.
+    """
+
+    def __init__(self, db_path='bot_database.db', max_workers=4, database=None):
+        """
+        Args:
+            db_path: Путь к файлу базы данных
+            max_workers: Количество потоков для выполнения запросов
+            database: Готовый синхронный объект базы (вместо db_path)
+        """
+        self.db = database if database is not None else Database(db_path)
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers,
+            thread_name_prefix='db'
+        )
+
+    async def _run(self, func, *args, **kwargs):
+        """Выполнение синхронного метода в пуле потоков"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, partial(func, *args, **kwargs)
+        )
+
+    def close(self):
+        """Остановка пула потоков и закрытие соединений"""
+        self.executor.shutdown(wait=True)
+        self.db.close()
+
+    async def init_db(self):
+        """Инициализация базы данных"""
+        return await self._run(self.db.init_db)
+
+    # ============= ПОЛЬЗОВАТЕЛИ =============
+
+    async def add_user(self, telegram_id, username):
+        """Добавление пользователя"""
+        return await self._run(self.db.add_user, telegram_id, username)
+
+    async def get_user(self, telegram_id):
+        """Получение пользователя"""
+        return await self._run(self.db.get_user, telegram_id)
+
+    # ============= КЛЮЧИ =============
+
+    async def add_key(self, key_value):
+        """Добавление ключа"""
+        return await self._run(self.db.add_key, key_value)
+
+    async def add_keys_bulk(self, key_values, chunk_size=1000, progress=None):
+        """Массовое добавление ключей"""
+        return await self._run(self.db.add_keys_bulk, key_values, chunk_size, progress)
+
+    async def key_filter(self, extra=0, error_rate=0.001):
+        """Фильтр Блума по всем ключам в базе"""
+        return await self._run(self.db.key_filter, extra, error_rate)
+
+    async def get_next_available_key(self):
+        """Получение следующего свободного ключа"""
+        return await self._run(self.db.get_next_available_key)
+
+    async def mark_key_as_used(self, key_id):
+        """Пометить ключ как использованный"""
+        return await self._run(self.db.mark_key_as_used, key_id)
+
+    async def get_available_keys_count(self, include_derived=False):
+        """Количество доступных ключей"""
+        return await self._run(self.db.get_available_keys_count, include_derived)
+
+    async def get_all_keys(self):
+        """Получение всех ключей"""
+        return await self._run(self.db.get_all_keys)
+
+    async def get_keys_page(self, after_id=None, limit=20, status_filter=None, before_id=None):
+        """Страница ключей с keyset-пагинацией"""
+        return await self._run(
+            self.db.get_keys_page, after_id, limit, status_filter, before_id
+        )
+
+    # ============= ЗАКАЗЫ =============
+
+    async def create_order(self, user_id, amount):
+        """Создание заказа"""
+        return await self._run(self.db.create_order, user_id, amount)
+
+    async def get_or_create_open_order(self, user_id, amount, max_age=None):
+        """Открытый заказ пользователя или новый"""
+        return await self._run(self.db.get_or_create_open_order, user_id, amount, max_age)
+
+    async def get_order(self, order_id):
+        """Получение заказа"""
+        return await self._run(self.db.get_order, order_id)
+
+    async def transition_order(self, order_id, status):
+        """Переход заказа в новый статус по ORDER_TRANSITIONS"""
+        return await self._run(self.db.transition_order, order_id, status)
+
+    async def update_order_status(self, order_id, status):
+        """Обновление статуса заказа"""
+        return await self._run(self.db.update_order_status, order_id, status)
+
+    async def claim_key_for_order(self, order_id):
+        """Атомарная выдача ключа по заказу"""
+        return await self._run(self.db.claim_key_for_order, order_id)
+
+    async def expire_stale_orders(self, created_ttl=3600, pending_ttl=None, batch_size=500):
+        """Перевод брошенных заказов в статус expired"""
+        return await self._run(self.db.expire_stale_orders, created_ttl, pending_ttl, batch_size)
+
+    async def get_pending_orders(self):
+        """Получение заказов в ожидании"""
+        return await self._run(self.db.get_pending_orders)
+
+    # ============= ПОКУПКИ =============
+
+    async def get_user_purchases(self, user_id):
+        """Получение покупок пользователя"""
+        return await self._run(self.db.get_user_purchases, user_id)
+
+    # ============= СТАТИСТИКА =============
+
+    async def get_statistics(self):
+        """Получение статистики"""
+        return await self._run(self.db.get_statistics)
+
+    async def reconcile_statistics(self):
+        """Пересчёт счётчиков статистики с нуля"""
+        return await self._run(self.db.reconcile_statistics)
+
+    # ============= ВЫГРУЗКА =============
+
+    async def export_table(self, table, output, fmt='csv', compress=False,
+                           date_from=None, date_to=None):
+        """Выгрузка таблицы в файл (см. export.export_table)"""
+        return await self._run(
+            export.export_table, self.db, table, output,
+            fmt=fmt, compress=compress, date_from=date_from, date_to=date_to
+        )
+
+    # ============= ИМПОРТ =============
+
+    async def import_keys(self, path, validator=None, rejects_path=None, chunk_size=5000, progress=None):
+        """Импорт ключей из файла (см. key_import.import_keys)"""
+        return await self._run(
+            key_import.import_keys, self.db, path,
+            validator=validator, rejects_path=rejects_path,
+            chunk_size=chunk_size, progress=progress
+        )
+
+    # ============= ЛОГИ =============
+
+    async def log_action(self, user_id, action, details=''):
+        """Логирование действий"""
+        return await self._run(self.db.log_action, user_id, action, details)
+
+    async def run_log_retention(self, retention):
+        """Один проход ретеншна логов (см. retention.LogRetention)"""
+        return await self._run(retention.run)
+
+    async def run_backup(self, manager):
+        """Горячий бэкап всех файлов базы (см. backup.BackupManager)"""
+        return await self._run(manager.backup)
+
+    async def flush_logs(self):
+        """Дождаться записи всех буферизованных логов"""
+        return await self._run(self.db.flush_logs)
@@ -0,0 +1,113 @@
+import atexit
+import logging
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+# Маркер остановки фонового потока
+_STOP = object()
+
+
+class AuditLogWriter:
+    """
+    Буферизованная запись в таблицу logs
+
+    События складываются в очередь в памяти, а фоновый поток сбрасывает их
+    пачками через executemany в одной транзакции: когда набралось
+    batch_size событий или прошло flush_interval секунд. Вместо коммита на
+    каждое событие получается один коммит на пачку.
+    """
+
+    def __init__(self, db, batch_size=500, flush_interval=1.0, max_queue=10000):
+        """
+        Args:
+            db: Объект Database, из которого берётся соединение
+            batch_size: Максимальный размер пачки
+            flush_interval: Максимальная задержка записи события, сек
+            max_queue: Размер очереди (при переполнении запись ждёт)
+        """
+        self.db = db
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Запуск фонового потока (повторный вызов ничего не делает)"""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(
+                target=self._run, name='audit-log-writer', daemon=True
+            )
+            self._thread.start()
+            atexit.register(self.close)
+
+    def put(self, user_id, action, details=''):
+        """Добавление события в очередь"""
+        if self._thread is None:
+            self.start()
+        created_at = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        self.queue.put((user_id, action, details, created_at))
+
+    def flush(self):
+        """Ожидание записи всех событий, поставленных в очередь"""
+        if self._thread is not None and self._thread.is_alive():
+            self.queue.join()
+
+    def close(self):
+        """Сброс оставшихся событий и остановка потока"""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is None or not thread.is_alive():
+            return
+        self.queue.put(_STOP)
+        thread.join()
+        atexit.unregister(self.close)
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = []
+            item = self.queue.get()
+            if item is _STOP:
+                self.queue.task_done()
+                break
+            batch.append(item)
+
+            # Добираем пачку до batch_size или до истечения flush_interval
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    self.queue.task_done()
+                    stopping = True
+                    break
+                batch.append(item)
+
+            self._write(batch)
+            for _ in batch:
+                self.queue.task_done()
+
+        self.db.close_thread_connection()
+
+    def _write(self, batch):
+        try:
+            conn = self.db.get_connection()
+            with conn:
+                conn.executemany(
+                    'INSERT INTO logs (user_id, action, details, created_at) VALUES (?, ?, ?, ?)',
+                    batch
+                )
+        except Exception as e:
+            logger.error(f"Ошибка записи пачки логов ({len(batch)} шт.): {e}")
@@ -0,0 +1,202 @@
+import argparse
+import gzip
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+from datetime import datetime
+
+from sharded_database import create_database
+
+logger = logging.getLogger(__name__)
+
+
+def integrity_check(path):
+    """
+    Проверка файла базы через PRAGMA integrity_check
+
+    Returns:
+        bool: True если база цела
+    """
+    conn = sqlite3.connect(path)
+    try:
+        result = conn.execute('PRAGMA integrity_check').fetchone()[0]
+    finally:
+        conn.close()
+    if result != 'ok':
+        logger.error(f"integrity_check {path}: {result}")
+    return result == 'ok'
+
+
+class BackupManager:
+    """
+    Горячий бэкап через online backup API SQLite
+
+    База копируется за один шаг: пошаговое копирование SQLite начинает
+    заново после каждой записи в исходный файл и при постоянных писателях
+    бота не заканчивается. В режиме WAL чтение снимка не блокирует
+    писателей. Каждый снимок проверяется integrity_check, сжимается gzip,
+    хранятся последние keep снимков на каждый файл базы.
+    """
+
+    def __init__(self, db, backup_dir='backups', keep=7):
+        """
+        Args:
+            db: Database или ShardedDatabase
+            backup_dir: Каталог для снимков
+            keep: Сколько последних снимков хранить на каждый файл
+        """
+        self.db = db
+        self.backup_dir = backup_dir
+        self.keep = keep
+
+    @staticmethod
+    def _stem(db_path):
+        return os.path.splitext(os.path.basename(db_path))[0]
+
+    def backup(self):
+        """
+        Снимок всех файлов базы
+
+        Returns:
+            list: Пути к созданным снимкам
+        """
+        os.makedirs(self.backup_dir, exist_ok=True)
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        snapshots = []
+        for database in self.db.get_databases():
+            stem = self._stem(database.db_path)
+            snapshot = os.path.join(self.backup_dir, f'{stem}_{timestamp}.db.gz')
+            self._backup_file(database, snapshot)
+            snapshots.append(snapshot)
+            self.rotate(stem)
+        return snapshots
+
+    def _backup_file(self, database, snapshot):
+        fd, tmp_path = tempfile.mkstemp(suffix='.db', dir=self.backup_dir)
+        os.close(fd)
+        try:
+            src = database.get_connection()
+            dst = sqlite3.connect(tmp_path)
+            try:
+                src.backup(dst)
+                # Снимок - одиночный файл, без -wal/-shm рядом
+                dst.execute('PRAGMA journal_mode = DELETE')
+            finally:
+                dst.close()
+
+            if not integrity_check(tmp_path):
+                raise RuntimeError(f"Снимок {database.db_path} не прошёл integrity_check")
+
+            with open(tmp_path, 'rb') as f_in, gzip.open(snapshot + '.part', 'wb') as f_out:
+                shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+            os.replace(snapshot + '.part', snapshot)
+            logger.info(f"Бэкап {database.db_path} -> {snapshot}")
+        finally:
+            os.remove(tmp_path)
+            if os.path.exists(snapshot + '.part'):
+                os.remove(snapshot + '.part')
+
+    def list_snapshots(self, stem):
+        """Снимки файла базы от старых к новым"""
+        if not os.path.isdir(self.backup_dir):
+            return []
+        prefix = f'{stem}_'
+        names = sorted(
+            name for name in os.listdir(self.backup_dir)
+            if name.startswith(prefix) and name.endswith('.db.gz')
+            and name[len(prefix):-len('.db.gz')].replace('_', '').isdigit()
+        )
+        return [os.path.join(self.backup_dir, name) for name in names]
+
+    def rotate(self, stem):
+        """Удаление снимков сверх keep"""
+        snapshots = self.list_snapshots(stem)
+        for path in snapshots[:-self.keep] if self.keep > 0 else []:
+            os.remove(path)
+            logger.info(f"Удалён старый бэкап {path}")
+
+
+def restore(snapshot, db_path):
+    """
+    Восстановление базы из снимка
+
+    Снимок распаковывается, проверяется integrity_check и копируется
+    в db_path через backup API. Бот на время восстановления нужно остановить.
+    """
+    fd, tmp_path = tempfile.mkstemp(suffix='.db', dir=os.path.dirname(os.path.abspath(db_path)))
+    os.close(fd)
+    try:
+        decompress(snapshot, tmp_path)
+
+        if not integrity_check(tmp_path):
+            raise RuntimeError(f"Снимок {snapshot} повреждён")
+
+        src = sqlite3.connect(tmp_path)
+        dst = sqlite3.connect(db_path)
+        try:
+            src.backup(dst)
+        finally:
+            src.close()
+            dst.close()
+        logger.info(f"База {db_path} восстановлена из {snapshot}")
+    finally:
+        os.remove(tmp_path)
+
+
+def decompress(snapshot, path):
+    """Распаковка снимка в файл"""
+    opener = gzip.open if snapshot.endswith('.gz') else open
+    with opener(snapshot, 'rb') as f_in, open(path, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+
+
+def backup_from_env(db):
+    """Настройки бэкапа из переменных окружения"""
+    return BackupManager(
+        db,
+        backup_dir=os.getenv('BACKUP_DIR', 'backups'),
+        keep=int(os.getenv('BACKUP_KEEP', '7')),
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Горячий бэкап и восстановление базы бота')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    backup_parser = subparsers.add_parser('backup', help='Сделать снимок без остановки бота')
+    backup_parser.add_argument('--db', help='Путь к базе данных')
+
+    restore_parser = subparsers.add_parser('restore', help='Восстановить файл базы из снимка')
+    restore_parser.add_argument('snapshot', help='Файл снимка (*.db.gz)')
+    restore_parser.add_argument('--db', default=os.getenv('DATABASE_PATH', 'bot_database.db'),
+                                help='Файл базы, который нужно перезаписать')
+
+    verify_parser = subparsers.add_parser('verify', help='Проверить снимок')
+    verify_parser.add_argument('snapshot')
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == 'backup':
+        db = create_database(args.db, buffered_logs=False)
+        try:
+            for snapshot in backup_from_env(db).backup():
+                print(snapshot)
+        finally:
+            db.close()
+    elif args.command == 'restore':
+        restore(args.snapshot, args.db)
+    elif args.command == 'verify':
+        fd, tmp_path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        try:
+            decompress(args.snapshot, tmp_path)
+            print('ok' if integrity_check(tmp_path) else 'corrupted')
+        finally:
+            os.remove(tmp_path)
+
+
+if __name__ == '__main__':
+    main()
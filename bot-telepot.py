@@ -1,11 +1,18 @@
 import telepot
+from telepot.exception import TooManyRequestsError
 from telepot.loop import MessageLoop
 from telepot.namedtuple import InlineKeyboardMarkup, InlineKeyboardButton
+import threading
 import time
 import os
 from dotenv import load_dotenv
-from database import Database
-from key_generator import KeyGenerator
+from database import CLAIM_OK, CLAIM_NOT_FOUND, CLAIM_ALREADY_CONFIRMED, CLAIM_OUT_OF_STOCK, CLAIM_INVALID_STATUS
+from key_generator import key_generator_from_env
+from sharded_database import create_database
+from outbound import (
+    ThreadedOutboundScheduler, send_priority, outbound_priority,
+    PRIORITY_KEY, PRIORITY_NOTIFICATION,
+)
 
 load_dotenv()
 
@@ -13,10 +20,85 @@ load_dotenv()
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 ADMIN_IDS = [int(x) for x in os.getenv('ADMIN_IDS', '').split(',') if x]
 
+# Истечение брошенных заказов, сек (0 - не истекают); заказ на проверке уже оплачен,
+# поэтому PENDING_ORDER_TTL_HOURS по умолчанию выключен
+ORDER_TTL = int(float(os.getenv('ORDER_TTL_MINUTES', '60')) * 60) or None
+PENDING_ORDER_TTL = int(float(os.getenv('PENDING_ORDER_TTL_HOURS', '0')) * 3600) or None
+ORDER_SWEEP_INTERVAL = float(os.getenv('ORDER_SWEEP_INTERVAL_SECONDS', '60'))
+NOTIFY_EXPIRED_ORDERS = os.getenv('NOTIFY_EXPIRED_ORDERS', '1') == '1'
+
+# Лимиты исходящих запросов Telegram: всего в секунду, в один чат в секунду, всплеск в чат
+OUTBOUND_GLOBAL_RATE = float(os.getenv('OUTBOUND_GLOBAL_RATE', '30'))
+OUTBOUND_CHAT_RATE = float(os.getenv('OUTBOUND_CHAT_RATE', '1'))
+OUTBOUND_CHAT_BURST = int(os.getenv('OUTBOUND_CHAT_BURST', '3'))
+
+
+def telegram_retry_after(error):
+    if isinstance(error, TooManyRequestsError):
+        return (error.json or {}).get('parameters', {}).get('retry_after', 1)
+    return None
+
+
+class OutboundBot:
+    """
+    telepot.Bot, у которого отправка идёт через очередь с лимитами
+
+    sendMessage, sendDocument, editMessageText и answerCallbackQuery
+    ставятся в ThreadedOutboundScheduler, остальные методы вызываются
+    напрямую. Уведомления (PRIORITY_NOTIFICATION) уходят без ожидания
+    ответа, чтобы не задерживать обработку апдейтов.
+    """
+    
+    SCHEDULED = ('sendMessage', 'sendDocument', 'editMessageText', 'answerCallbackQuery')
+    
+    def __init__(self, bot, scheduler):
+        self._bot = bot
+        self._scheduler = scheduler
+    
+    def __getattr__(self, name):
+        method = getattr(self._bot, name)
+        if name not in self.SCHEDULED:
+            return method
+        
+        def call(*args, **kwargs):
+            chat_id = self._chat_id(name, args, kwargs)
+            wait = outbound_priority.get() != PRIORITY_NOTIFICATION
+            result = self._scheduler.submit(lambda: method(*args, **kwargs), chat_id, wait=wait)
+            if not wait:
+                result.add_done_callback(self._log_failure)
+            return result
+        return call
+    
+    @staticmethod
+    def _chat_id(name, args, kwargs):
+        if name == 'answerCallbackQuery':
+            return None
+        if name == 'editMessageText':
+            # msg_identifier: (chat_id, message_id) или inline_message_id
+            identifier = args[0] if args else kwargs.get('msg_identifier')
+            return identifier[0] if isinstance(identifier, tuple) else None
+        return args[0] if args else kwargs.get('chat_id')
+    
+    @staticmethod
+    def _log_failure(future):
+        if future.exception() is not None:
+            print(f"Ошибка отправки уведомления: {future.exception()}")
+
+
 # Инициализация
-bot = telepot.Bot(BOT_TOKEN)
-db = Database()
-key_gen = KeyGenerator()
+telegram = telepot.Bot(BOT_TOKEN)
+outbound = ThreadedOutboundScheduler(
+    OUTBOUND_GLOBAL_RATE, OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST,
+    retry_after=telegram_retry_after
+)
+bot = OutboundBot(telegram, outbound)
+key_gen = key_generator_from_env()
+key_codec = key_gen.codec() if os.getenv('KEY_STORAGE') == 'compact' else None
+# KEY_SOURCE=derived - когда пул пуст, ключ выводится по номеру при выдаче
+key_deriver = key_gen if os.getenv('KEY_SOURCE') == 'derived' else None
+if key_deriver is not None and key_gen.permutation is None:
+    raise RuntimeError("KEY_SOURCE=derived требует KEY_DERIVE_SECRET")
+db = create_database(key_codec=key_codec, key_deriver=key_deriver)
 
 print("Бот запущен!")
 
@@ -61,6 +143,36 @@ def confirm_payment_kb(order_id):
     ])
 
 
+# ============= ТЕКСТЫ =============
+
+ORDER_STATUS_TEXTS = {
+    'created': "❌ Заказ ещё не оплачен",
+    'pending': "⏳ Оплата уже отправлена на проверку",
+    'confirmed': "✅ Этот заказ уже подтверждён",
+    'rejected': "❌ Этот заказ отклонён",
+    'expired': "⌛ Срок заказа истёк, оформите новый",
+}
+
+
+def expired_order_text(order):
+    """Уведомление об истёкшем заказе: брошенном или так и не проверенном"""
+    if order['status'] == 'pending':
+        return (
+            f"⌛ Заказ ORDER{order['id']} не успели проверить, и он закрыт.\n\n"
+            f"Повторно платить не нужно: свяжитесь с поддержкой, и мы выдадим ключ."
+        )
+    return (
+        f"⌛ Срок заказа ORDER{order['id']} истёк.\n\n"
+        f"Если вы всё ещё хотите купить ключ, оформите новый заказ."
+    )
+
+
+def invalid_transition_text(result):
+    if result.not_found:
+        return "❌ Заказ не найден"
+    return ORDER_STATUS_TEXTS.get(result.current_status, "❌ Действие недоступно для этого заказа")
+
+
 # ============= ОБРАБОТЧИКИ =============
 
 def handle(msg):
@@ -114,27 +226,23 @@ def handle(msg):
         parts = text.split()
         count = int(parts[1]) if len(parts) > 1 else 1
         
-        added = 0
-        for _ in range(count):
-            key_value = key_gen.generate()
-            if db.add_key(key_value):
-                added += 1
+        result = db.add_keys_bulk(key_gen.generate_batch(count, exclude=db.key_filter(extra=count)))
         
-        bot.sendMessage(chat_id, f"✅ Добавлено {added} ключей")
+        bot.sendMessage(chat_id, f"✅ Добавлено {result['inserted']} ключей")
     
     elif text == '/listkeys':
         if user_id not in ADMIN_IDS:
             return
         
-        keys = db.get_all_keys()
+        page = db.get_keys_page(limit=20)
         
-        text = f"🔑 Всего ключей: {len(keys)}\n\n"
-        for key in keys[:20]:
+        text = f"🔑 Доступно ключей: {db.get_statistics()['available_keys']}\n\n"
+        for key in page['keys']:
             status = "✅" if key['is_used'] == 0 else "❌"
             text += f"{status} `{key['key_value']}`\n"
         
-        if len(keys) > 20:
-            text += f"\n... и ещё {len(keys) - 20}"
+        if page['has_next']:
+            text += "\n... и ещё"
         
         bot.sendMessage(chat_id, text, parse_mode='Markdown')
 
@@ -155,21 +263,22 @@ def handle_callback(msg):
     
     # Купить ключ
     elif data == 'buy_key':
-        available_keys = db.get_available_keys_count()
+        available_keys = db.get_available_keys_count(include_derived=True)
         
         if available_keys == 0:
             bot.answerCallbackQuery(query_id, text="❌ К сожалению, ключи закончились", show_alert=True)
             return
         
         price = 500
-        order_id = db.create_order(from_id, price)
+        # Запас ключей по счётчику огромен, покупателю его не показываем
+        stock_line = f"📦 Доступно ключей: {available_keys}\n" if key_deriver is None else ""
+        order_id = db.get_or_create_open_order(from_id, price, max_age=ORDER_TTL)
         
         payment_text = f"""
 🔑 Покупка ключа
 
 💰 Цена: {price} ₽
-📦 Доступно ключей: {available_keys}
-
+{stock_line}
 📋 Реквизиты для оплаты:
 
 💳 Карта СБП: 2200 7007 1234 5678
@@ -187,18 +296,12 @@ def handle_callback(msg):
     # Я оплатил
     elif data.startswith('paid_'):
         order_id = int(data.split('_')[1])
-        order = db.get_order(order_id)
+        order = db.transition_order(order_id, 'pending')
         
         if not order:
-            bot.answerCallbackQuery(query_id, text="❌ Заказ не найден", show_alert=True)
+            bot.answerCallbackQuery(query_id, text=invalid_transition_text(order), show_alert=True)
             return
         
-        if order['status'] == 'confirmed':
-            bot.answerCallbackQuery(query_id, text="✅ Этот заказ уже подтверждён", show_alert=True)
-            return
-        
-        db.update_order_status(order_id, 'pending')
-        
         bot.editMessageText(
             (chat_id, message_id),
             "✅ Спасибо! Ваша оплата отправлена на проверку.\n\n"
@@ -208,8 +311,9 @@ def handle_callback(msg):
         )
         
         # Уведомление админам
-        for admin_id in ADMIN_IDS:
-            try:
+        # Уведомления ставятся в очередь без ожидания отправки
+        with send_priority(PRIORITY_NOTIFICATION):
+            for admin_id in ADMIN_IDS:
                 bot.sendMessage(
                     admin_id,
                     f"💰 Новая оплата!\n\n"
@@ -218,8 +322,6 @@ def handle_callback(msg):
                     f"💵 Сумма: {order['amount']} ₽",
                     reply_markup=confirm_payment_kb(order_id)
                 )
-            except Exception as e:
-                print(f"Ошибка отправки админу {admin_id}: {e}")
         
         bot.answerCallbackQuery(query_id)
     
@@ -334,28 +436,41 @@ def handle_callback(msg):
             return
         
         order_id = int(data.split('_')[1])
-        order = db.get_order(order_id)
+        result = db.claim_key_for_order(order_id)
         
-        if not order:
+        if result['status'] == CLAIM_NOT_FOUND:
             bot.answerCallbackQuery(query_id, text="❌ Заказ не найден", show_alert=True)
             return
         
-        key = db.get_next_available_key()
-        if not key:
+        if result['status'] == CLAIM_ALREADY_CONFIRMED:
+            bot.answerCallbackQuery(query_id, text="✅ Этот заказ уже подтверждён", show_alert=True)
+            return
+        
+        if result['status'] == CLAIM_OUT_OF_STOCK:
             bot.answerCallbackQuery(query_id, text="❌ Нет доступных ключей!", show_alert=True)
             return
         
-        db.confirm_order(order_id, key['id'])
+        if result['status'] == CLAIM_INVALID_STATUS:
+            bot.answerCallbackQuery(query_id, text="❌ Заказ закрыт и не может быть подтверждён", show_alert=True)
+            return
+        
+        if result['status'] != CLAIM_OK:
+            bot.answerCallbackQuery(query_id, text="⚠️ Ошибка подтверждения заказа", show_alert=True)
+            return
+        
+        order = result['order']
+        key = result['key']
         
         try:
-            bot.sendMessage(
-                order['user_id'],
-                f"✅ Оплата подтверждена!\n\n"
-                f"🔑 Ваш ключ: `{key['key_value']}`\n"
-                f"📅 Дата покупки: {order['created_at']}\n\n"
-                f"Спасибо за покупку! 🎉",
-                parse_mode='Markdown'
-            )
+            with send_priority(PRIORITY_KEY):
+                bot.sendMessage(
+                    order['user_id'],
+                    f"✅ Оплата подтверждена!\n\n"
+                    f"🔑 Ваш ключ: `{key['key_value']}`\n"
+                    f"📅 Дата покупки: {order['created_at']}\n\n"
+                    f"Спасибо за покупку! 🎉",
+                    parse_mode='Markdown'
+                )
             
             bot.editMessageText(
                 (chat_id, message_id),
@@ -373,9 +488,11 @@ def handle_callback(msg):
             return
         
         order_id = int(data.split('_')[1])
-        db.update_order_status(order_id, 'rejected')
+        order = db.transition_order(order_id, 'rejected')
         
-        order = db.get_order(order_id)
+        if not order:
+            bot.answerCallbackQuery(query_id, text=invalid_transition_text(order), show_alert=True)
+            return
         
         try:
             bot.sendMessage(
@@ -392,10 +509,25 @@ def handle_callback(msg):
 
 # ============= ЗАПУСК =============
 
+def order_expiry_loop():
+    """Периодическое истечение брошенных заказов (в отдельном потоке)"""
+    while True:
+        try:
+            expired = db.expire_stale_orders(ORDER_TTL, PENDING_ORDER_TTL)
+            if NOTIFY_EXPIRED_ORDERS:
+                with send_priority(PRIORITY_NOTIFICATION):
+                    for order in expired:
+                        bot.sendMessage(order['user_id'], expired_order_text(order), reply_markup=main_menu_kb())
+        except Exception as e:
+            print(f"Ошибка истечения заказов: {e}")
+        time.sleep(ORDER_SWEEP_INTERVAL)
+
+
 if __name__ == '__main__':
     db.init_db()
     
-    MessageLoop(bot, {'chat': handle, 'callback_query': handle_callback}).run_as_thread()
+    MessageLoop(telegram, {'chat': handle, 'callback_query': handle_callback}).run_as_thread()
+    threading.Thread(target=order_expiry_loop, daemon=True).start()
     
     print('Бот запущен и работает!')
     
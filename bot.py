@@ -2,15 +2,33 @@ import asyncio
 import logging
 from aiogram import Bot, Dispatcher, F, Router
 from aiogram.filters import CommandStart, Command
-from aiogram.types import Message, CallbackQuery
+from aiogram.types import Message, CallbackQuery, FSInputFile
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import AnswerCallbackQuery
 import os
+import tempfile
 from dotenv import load_dotenv
-from database import Database
-from key_generator import KeyGenerator
+from async_database import AsyncDatabase
+from sharded_database import create_database
+from database import CLAIM_OK, CLAIM_NOT_FOUND, CLAIM_ALREADY_CONFIRMED, CLAIM_OUT_OF_STOCK, CLAIM_INVALID_STATUS, EXPORT_TABLES
+from key_generator import key_generator_from_env
+from key_import import validator_for
+from export import EXPORT_FORMATS, export_filename
+from retention import retention_from_env
+from backup import backup_from_env
+from webhook import webhook_from_env
+from notifier import AdminNotifier
+from outbound import (
+    OutboundScheduler, send_priority, outbound_priority,
+    PRIORITY_KEY, PRIORITY_NOTIFICATION,
+)
 
 load_dotenv()
 
@@ -21,19 +39,103 @@ logger = logging.getLogger(__name__)
 # Конфигурация
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 ADMIN_IDS = [int(x) for x in os.getenv('ADMIN_IDS', '').split(',') if x]
+LOG_RETENTION_INTERVAL = float(os.getenv('LOG_RETENTION_INTERVAL_HOURS', '24')) * 3600
+
+# Истечение брошенных заказов (0 - не истекают)
+ORDER_TTL = int(float(os.getenv('ORDER_TTL_MINUTES', '60')) * 60) or None
+# Заказ на проверке уже оплачен, поэтому по умолчанию он не истекает
+PENDING_ORDER_TTL = int(float(os.getenv('PENDING_ORDER_TTL_HOURS', '0')) * 3600) or None
+ORDER_SWEEP_INTERVAL = float(os.getenv('ORDER_SWEEP_INTERVAL_SECONDS', '60'))
+NOTIFY_EXPIRED_ORDERS = os.getenv('NOTIFY_EXPIRED_ORDERS', '1') == '1'
+
+# Горячий бэкап по расписанию (0 - выключен)
+BACKUP_INTERVAL = float(os.getenv('BACKUP_INTERVAL_HOURS', '24')) * 3600
+
+# Режим приёма апдейтов: polling, webhook или local (вебхук без регистрации в Telegram)
+RUN_MODE = os.getenv('RUN_MODE', 'polling')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '').rstrip('/')
+WEBAPP_HOST = os.getenv('WEBAPP_HOST', '0.0.0.0')
+WEBAPP_PORT = int(os.getenv('WEBAPP_PORT', '8080'))
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))
+# Свой адрес Bot API (локальный telegram-bot-api или заглушка для тестов)
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
+# Лимиты исходящих запросов Telegram: всего в секунду, в один чат в секунду, всплеск в чат
+OUTBOUND_GLOBAL_RATE = float(os.getenv('OUTBOUND_GLOBAL_RATE', '30'))
+OUTBOUND_CHAT_RATE = float(os.getenv('OUTBOUND_CHAT_RATE', '1'))
+OUTBOUND_CHAT_BURST = int(os.getenv('OUTBOUND_CHAT_BURST', '3'))
+# Периодические задачи (ретеншн, истечение заказов, бэкап); при нескольких
+# экземплярах за балансировщиком их достаточно держать включёнными на одном
+BACKGROUND_JOBS = os.getenv('BACKGROUND_JOBS', '1') == '1'
+
+
+class OutboundMiddleware(BaseRequestMiddleware):
+    """
+    Все запросы в чаты и ответы на callback - через очередь с лимитами
+
+    Служебные запросы (getUpdates, setWebhook, getFile) идут напрямую.
+    """
+    
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+    
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, 'chat_id', None)
+        if chat_id is None and not isinstance(method, AnswerCallbackQuery):
+            return await make_request(bot, method)
+        return await self.scheduler.submit(lambda: make_request(bot, method), chat_id)
+
+
+def telegram_retry_after(error):
+    return error.retry_after if isinstance(error, TelegramRetryAfter) else None
+
 
 # Инициализация
-bot = Bot(token=BOT_TOKEN)
+session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+bot = Bot(token=BOT_TOKEN, session=session)
+outbound = OutboundScheduler(
+    OUTBOUND_GLOBAL_RATE, OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST,
+    retry_after=telegram_retry_after
+)
+bot.session.middleware(OutboundMiddleware(outbound))
 dp = Dispatcher(storage=MemoryStorage())
 router = Router()
-db = Database()
-key_gen = KeyGenerator()
+key_gen = key_generator_from_env()
+# KEY_STORAGE=compact - хранить ключи по шаблону упакованными (BLOB)
+key_codec = key_gen.codec() if os.getenv('KEY_STORAGE') == 'compact' else None
+# KEY_SOURCE=derived - когда пул пуст, ключ выводится по номеру при выдаче
+key_deriver = key_gen if os.getenv('KEY_SOURCE') == 'derived' else None
+if key_deriver is not None and key_gen.permutation is None:
+    raise RuntimeError("KEY_SOURCE=derived требует KEY_DERIVE_SECRET")
+db = AsyncDatabase(database=create_database(key_codec=key_codec, key_deriver=key_deriver))
+notifier = AdminNotifier(bot, ADMIN_IDS)
+
+# Ссылки на фоновые задачи, чтобы их не собрал сборщик мусора
+background_tasks = set()
+
+
+def spawn_background(coro):
+    """
+    Запуск долгой задачи администратора в фоне
+
+    Обработчик сразу возвращается и не задерживает обработку других апдейтов.
+    Сообщения задачи (прогресс, итог) уступают в очереди исходящих ответам
+    пользователям: задача наследует приоритет из контекста при создании.
+    """
+    with send_priority(PRIORITY_NOTIFICATION):
+        task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
 
 
 class PaymentStates(StatesGroup):
     waiting_payment = State()
 
 
+class ImportStates(StatesGroup):
+    waiting_file = State()
+
+
 # ============= КЛАВИАТУРЫ =============
 
 def main_menu_kb():
@@ -77,6 +179,46 @@ def confirm_payment_kb(order_id):
     return InlineKeyboardMarkup(inline_keyboard=kb)
 
 
+def payment_digest_kb(order_id):
+    """Кнопки заказа в сводке уведомлений: одна строка с номером заказа"""
+    kb = [[
+        InlineKeyboardButton(text=f"✅ ORDER{order_id}", callback_data=f"confirm_{order_id}"),
+        InlineKeyboardButton(text=f"❌ ORDER{order_id}", callback_data=f"reject_{order_id}"),
+    ]]
+    return InlineKeyboardMarkup(inline_keyboard=kb)
+
+
+# ============= ТЕКСТЫ =============
+
+ORDER_STATUS_TEXTS = {
+    'created': "❌ Заказ ещё не оплачен",
+    'pending': "⏳ Оплата уже отправлена на проверку",
+    'confirmed': "✅ Этот заказ уже подтверждён",
+    'rejected': "❌ Этот заказ отклонён",
+    'expired': "⌛ Срок заказа истёк, оформите новый",
+}
+
+
+def expired_order_text(order):
+    """Уведомление об истёкшем заказе: брошенном или так и не проверенном"""
+    if order['status'] == 'pending':
+        return (
+            f"⌛ Заказ ORDER{order['id']} не успели проверить, и он закрыт.\n\n"
+            f"Повторно платить не нужно: свяжитесь с поддержкой, и мы выдадим ключ."
+        )
+    return (
+        f"⌛ Срок заказа ORDER{order['id']} истёк.\n\n"
+        f"Если вы всё ещё хотите купить ключ, оформите новый заказ."
+    )
+
+
+def invalid_transition_text(result):
+    """Текст для пользователя при недопустимой смене статуса заказа"""
+    if result.not_found:
+        return "❌ Заказ не найден"
+    return ORDER_STATUS_TEXTS.get(result.current_status, "❌ Действие недоступно для этого заказа")
+
+
 # ============= ОБРАБОТЧИКИ ПОЛЬЗОВАТЕЛЕЙ =============
 
 @router.message(CommandStart())
@@ -85,7 +227,7 @@ async def cmd_start(message: Message):
     username = message.from_user.username or "Пользователь"
     
     # Регистрация пользователя
-    db.add_user(user_id, username)
+    await db.add_user(user_id, username)
     
     welcome_text = f"""
 👋 Добро пожаловать, {message.from_user.first_name}!
@@ -113,23 +255,24 @@ async def back_to_start(callback: CallbackQuery):
 @router.callback_query(F.data == "buy_key")
 async def buy_key(callback: CallbackQuery):
     # Проверка наличия ключей
-    available_keys = db.get_available_keys_count()
+    available_keys = await db.get_available_keys_count(include_derived=True)
     
     if available_keys == 0:
         await callback.answer("❌ К сожалению, ключи закончились", show_alert=True)
         return
     
     price = 500  # Цена в рублях
+    # Запас ключей по счётчику огромен, покупателю его не показываем
+    stock_line = f"📦 Доступно ключей: {available_keys}\n" if key_deriver is None else ""
     
-    # Создание заказа
-    order_id = db.create_order(callback.from_user.id, price)
+    # Повторное нажатие переиспользует открытый заказ
+    order_id = await db.get_or_create_open_order(callback.from_user.id, price, max_age=ORDER_TTL)
     
     payment_text = f"""
 🔑 Покупка ключа
 
 💰 Цена: {price} ₽
-📦 Доступно ключей: {available_keys}
-
+{stock_line}
 📋 Реквизиты для оплаты:
 
 💳 Карта СБП: 2200 7007 1234 5678
@@ -149,19 +292,12 @@ async def buy_key(callback: CallbackQuery):
 async def user_paid(callback: CallbackQuery):
     order_id = int(callback.data.split("_")[1])
     
-    # Проверка существования заказа
-    order = db.get_order(order_id)
+    # Переход created -> pending, повторные и поздние нажатия отсекаются
+    order = await db.transition_order(order_id, 'pending')
     if not order:
-        await callback.answer("❌ Заказ не найден", show_alert=True)
+        await callback.answer(invalid_transition_text(order), show_alert=True)
         return
     
-    if order['status'] == 'confirmed':
-        await callback.answer("✅ Этот заказ уже подтверждён", show_alert=True)
-        return
-    
-    # Обновление статуса
-    db.update_order_status(order_id, 'pending')
-    
     await callback.message.edit_text(
         "✅ Спасибо! Ваша оплата отправлена на проверку.\n\n"
         "⏳ Обычно проверка занимает 5-15 минут.\n"
@@ -169,19 +305,15 @@ async def user_paid(callback: CallbackQuery):
         reply_markup=back_to_menu_kb()
     )
     
-    # Уведомление админам
-    for admin_id in ADMIN_IDS:
-        try:
-            await bot.send_message(
-                admin_id,
-                f"💰 Новая оплата!\n\n"
-                f"📝 Заказ: ORDER{order_id}\n"
-                f"👤 Пользователь: {callback.from_user.username or callback.from_user.id}\n"
-                f"💵 Сумма: {order['amount']} ₽",
-                reply_markup=confirm_payment_kb(order_id)
-            )
-        except Exception as e:
-            logger.error(f"Ошибка отправки уведомления админу {admin_id}: {e}")
+    # Уведомление админам уходит в фоне, ответ пользователю его не ждёт
+    notifier.notify(
+        f"💰 Новая оплата!\n\n"
+        f"📝 Заказ: ORDER{order_id}\n"
+        f"👤 Пользователь: {callback.from_user.username or callback.from_user.id}\n"
+        f"💵 Сумма: {order['amount']} ₽",
+        reply_markup=confirm_payment_kb(order_id),
+        digest_markup=payment_digest_kb(order_id)
+    )
     
     await callback.answer()
 
@@ -209,7 +341,7 @@ async def payment_methods(callback: CallbackQuery):
 @router.callback_query(F.data == "my_purchases")
 async def my_purchases(callback: CallbackQuery):
     user_id = callback.from_user.id
-    purchases = db.get_user_purchases(user_id)
+    purchases = await db.get_user_purchases(user_id)
     
     if not purchases:
         text = "📦 У вас пока нет покупок"
@@ -258,7 +390,7 @@ async def admin_stats(callback: CallbackQuery):
         await callback.answer("❌ Доступ запрещён", show_alert=True)
         return
     
-    stats = db.get_statistics()
+    stats = await db.get_statistics()
     
     text = f"""
 📊 Статистика
@@ -274,13 +406,46 @@ async def admin_stats(callback: CallbackQuery):
     await callback.answer()
 
 
+@router.message(Command("reconcilestats"))
+async def reconcile_stats(message: Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    
+    stats = await db.reconcile_statistics()
+    
+    await message.answer(
+        f"🔄 Статистика пересчитана\n\n"
+        f"👥 Пользователей: {stats['total_users']}\n"
+        f"💰 Продаж: {stats['total_sales']}\n"
+        f"🔑 Доступно ключей: {stats['available_keys']}\n"
+        f"⏳ Ожидают подтверждения: {stats['pending_orders']}"
+    )
+
+
+@router.message(Command("outbound"))
+async def outbound_stats(message: Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    
+    stats = outbound.stats()
+    depth = stats['depth_by_priority']
+    await message.answer(
+        f"📤 Исходящая очередь\n\n"
+        f"В очереди: {stats['depth']} "
+        f"(ключи {depth['key']}, ответы {depth['interactive']}, уведомления {depth['notification']})\n"
+        f"Отправлено: {stats['sent']}, повторов: {stats['retried']}, ошибок: {stats['failed']}\n"
+        f"Ожидание в очереди: ср. {stats['latency_avg']:.2f} с, "
+        f"p95 {stats['latency_p95']:.2f} с, макс. {stats['latency_max']:.2f} с"
+    )
+
+
 @router.callback_query(F.data == "admin_payments")
 async def admin_payments(callback: CallbackQuery):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer("❌ Доступ запрещён", show_alert=True)
         return
     
-    pending = db.get_pending_orders()
+    pending = await db.get_pending_orders()
     
     if not pending:
         text = "✅ Нет ожидающих оплат"
@@ -305,31 +470,44 @@ async def confirm_payment(callback: CallbackQuery):
         return
     
     order_id = int(callback.data.split("_")[1])
-    order = db.get_order(order_id)
     
-    if not order:
+    # Атомарная выдача ключа
+    result = await db.claim_key_for_order(order_id)
+    
+    if result['status'] == CLAIM_NOT_FOUND:
         await callback.answer("❌ Заказ не найден", show_alert=True)
         return
     
-    # Получение ключа
-    key = db.get_next_available_key()
-    if not key:
+    if result['status'] == CLAIM_ALREADY_CONFIRMED:
+        await callback.answer("✅ Этот заказ уже подтверждён", show_alert=True)
+        return
+    
+    if result['status'] == CLAIM_OUT_OF_STOCK:
         await callback.answer("❌ Нет доступных ключей!", show_alert=True)
         return
     
-    # Подтверждение заказа
-    db.confirm_order(order_id, key['id'])
+    if result['status'] == CLAIM_INVALID_STATUS:
+        await callback.answer("❌ Заказ закрыт и не может быть подтверждён", show_alert=True)
+        return
+    
+    if result['status'] != CLAIM_OK:
+        await callback.answer("⚠️ Ошибка подтверждения заказа", show_alert=True)
+        return
+    
+    order = result['order']
+    key = result['key']
     
-    # Отправка ключа пользователю
+    # Отправка ключа пользователю, вне очереди уведомлений
     try:
-        await bot.send_message(
-            order['user_id'],
-            f"✅ Оплата подтверждена!\n\n"
-            f"🔑 Ваш ключ: `{key['key_value']}`\n"
-            f"📅 Дата покупки: {order['created_at']}\n\n"
-            f"Спасибо за покупку! 🎉",
-            parse_mode="Markdown"
-        )
+        with send_priority(PRIORITY_KEY):
+            await bot.send_message(
+                order['user_id'],
+                f"✅ Оплата подтверждена!\n\n"
+                f"🔑 Ваш ключ: `{key['key_value']}`\n"
+                f"📅 Дата покупки: {order['created_at']}\n\n"
+                f"Спасибо за покупку! 🎉",
+                parse_mode="Markdown"
+            )
         
         await callback.message.edit_text(
             f"✅ Заказ ORDER{order_id} подтверждён\n"
@@ -349,9 +527,10 @@ async def reject_payment(callback: CallbackQuery):
         return
     
     order_id = int(callback.data.split("_")[1])
-    db.update_order_status(order_id, 'rejected')
-    
-    order = db.get_order(order_id)
+    order = await db.transition_order(order_id, 'rejected')
+    if not order:
+        await callback.answer(invalid_transition_text(order), show_alert=True)
+        return
     
     try:
         await bot.send_message(
@@ -381,6 +560,9 @@ async def admin_keys(callback: CallbackQuery):
 Для добавления нескольких ключей:
 /addkeys 10 - сгенерирует 10 ключей
 
+Для импорта ключей из файла поставщика:
+/importkeys - затем отправьте файл .txt или .csv
+
 Для просмотра всех ключей:
 /listkeys
 """
@@ -400,7 +582,7 @@ async def add_key(message: Message):
         return
     
     key_value = args[1].strip()
-    if db.add_key(key_value):
+    if await db.add_key(key_value):
         await message.answer(f"✅ Ключ {key_value} добавлен")
     else:
         await message.answer("❌ Ключ уже существует или ошибка")
@@ -414,41 +596,378 @@ async def add_keys(message: Message):
     args = message.text.split()
     count = int(args[1]) if len(args) > 1 else 1
     
-    added = 0
-    for _ in range(count):
-        key_value = key_gen.generate()
-        if db.add_key(key_value):
-            added += 1
+    progress_message = await message.answer(f"⏳ Генерация {count} ключей...")
     
-    await message.answer(f"✅ Добавлено {added} ключей")
+    spawn_background(generate_keys_task(progress_message, count))
 
 
-@router.message(Command("listkeys"))
-async def list_keys(message: Message):
+def generate_unique_chunk(count, existing):
+    """Пачка новых ключей, не пересекающихся с фильтром existing (пополняет его)"""
+    chunk = key_gen.generate_batch(count, exclude=existing)
+    existing.update(chunk)
+    return chunk
+
+
+async def generate_keys_task(progress_message: Message, count, chunk_size=5000):
+    loop = asyncio.get_running_loop()
+    inserted = 0
+    duplicates = 0
+    try:
+        # Кандидаты сверяются с уже имеющимися ключами до вставки
+        existing = await db.key_filter(extra=count)
+        for start in range(0, count, chunk_size):
+            # Генерация и хэширование в фильтре - в пуле потоков, не в цикле событий
+            chunk = await loop.run_in_executor(
+                None, generate_unique_chunk, min(chunk_size, count - start), existing
+            )
+            result = await db.add_keys_bulk(chunk, chunk_size=chunk_size)
+            inserted += result['inserted']
+            duplicates += result['duplicates']
+            
+            if start + chunk_size < count:
+                await progress_message.edit_text(
+                    f"⏳ Генерация ключей: {start + len(chunk)}/{count}\n"
+                    f"✅ Добавлено: {inserted}"
+                )
+    except Exception as e:
+        logger.error(f"Ошибка генерации ключей: {e}")
+        await progress_message.edit_text(f"❌ Ошибка генерации ключей, добавлено {inserted}")
+        return
+    
+    text = f"✅ Добавлено {inserted} ключей"
+    if duplicates:
+        text += f"\n⚠️ Дубликатов пропущено: {duplicates}"
+    await progress_message.edit_text(text)
+
+
+@router.message(Command("importkeys"))
+async def import_keys_start(message: Message, state: FSMContext):
     if message.from_user.id not in ADMIN_IDS:
         return
     
-    keys = db.get_all_keys()
+    args = message.text.split(maxsplit=1)
+    pattern = args[1].strip() if len(args) > 1 else None
+    try:
+        validator_for(pattern, key_gen)
+    except ValueError as e:
+        await message.answer(f"❌ Неверный шаблон: {e}")
+        return
+    
+    await state.set_state(ImportStates.waiting_file)
+    await state.update_data(pattern=pattern)
+    await message.answer(
+        "📄 Отправьте файл с ключами: .txt (по ключу в строке) или .csv (первая колонка)\n"
+        f"Формат: {pattern or key_gen.format_pattern}\n"
+        "Без проверки формата: /importkeys any\n"
+        "Отмена: /cancel"
+    )
+
+
+@router.message(ImportStates.waiting_file, Command("cancel"))
+async def import_keys_cancel(message: Message, state: FSMContext):
+    await state.clear()
+    await message.answer("Импорт отменён")
+
+
+@router.message(ImportStates.waiting_file, F.document)
+async def import_keys_file(message: Message, state: FSMContext):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    
+    data = await state.get_data()
+    await state.clear()
+    
+    progress_message = await message.answer("⏳ Загрузка файла...")
+    
+    spawn_background(import_keys_task(progress_message, message.document, data.get('pattern')))
+
+
+async def import_keys_task(progress_message: Message, document, pattern, progress_interval=3.0):
+    suffix = '.csv' if (document.file_name or '').lower().endswith('.csv') else '.txt'
+    fd, path = tempfile.mkstemp(suffix=suffix)
+    os.close(fd)
+    rejects_path = path + '.rejects.csv'
+    loop = asyncio.get_running_loop()
+    last_update = 0.0
+    last_edit = None
+    
+    def progress(processed, inserted, rejected):
+        # Вызывается из потока базы; правим сообщение не чаще progress_interval
+        nonlocal last_update, last_edit
+        now = loop.time()
+        if now - last_update < progress_interval:
+            return
+        last_update = now
+        last_edit = asyncio.run_coroutine_threadsafe(
+            edit_progress(
+                f"⏳ Импорт ключей: обработано {processed}\n"
+                f"✅ Добавлено: {inserted}\n"
+                f"⚠️ Отклонено: {rejected}"
+            ),
+            loop
+        )
+    
+    async def edit_progress(text):
+        # Корутина из потока базы не наследует приоритет задачи
+        with send_priority(PRIORITY_NOTIFICATION):
+            await progress_message.edit_text(text)
     
-    text = f"🔑 Всего ключей: {len(keys)}\n\n"
-    for key in keys[:20]:
+    try:
+        await bot.download(document, destination=path)
+        await progress_message.edit_text("⏳ Импорт ключей...")
+        result = await db.import_keys(
+            path,
+            validator=validator_for(pattern, key_gen),
+            rejects_path=rejects_path,
+            progress=progress
+        )
+        # Поздняя правка прогресса не должна затереть итоговый отчёт
+        if last_edit is not None:
+            await asyncio.gather(asyncio.wrap_future(last_edit), return_exceptions=True)
+        
+        text = f"✅ Импорт завершён\nСтрок: {result['processed']}\nДобавлено: {result['inserted']}"
+        if result['rejected']:
+            text += f"\n⚠️ Отклонено: {result['rejected']}"
+            top_reasons = sorted(result['reasons'].items(), key=lambda item: -item[1])[:5]
+            for reason, count in top_reasons:
+                text += f"\n• {reason}: {count}"
+        await progress_message.edit_text(text)
+        
+        if result['rejects_path']:
+            await progress_message.answer_document(
+                FSInputFile(result['rejects_path'], filename='rejects.csv'),
+                caption="📄 Отклонённые строки"
+            )
+    except Exception as e:
+        logger.error(f"Ошибка импорта ключей: {e}")
+        await progress_message.edit_text("❌ Ошибка импорта ключей")
+    finally:
+        for tmp in (path, rejects_path):
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+
+KEYS_PAGE_SIZE = 20
+KEYS_FILTERS = {
+    'all': ("Все", None),
+    'unused': ("Свободные", 'unused'),
+    'used': ("Использованные", 'used'),
+}
+
+
+def keys_page_kb(page, key_filter):
+    filter_row = [
+        InlineKeyboardButton(
+            text=("• " if name == key_filter else "") + title,
+            callback_data=f"keys:{name}:first"
+        )
+        for name, (title, _) in KEYS_FILTERS.items()
+    ]
+    nav_row = []
+    if page['has_prev'] and page['keys']:
+        nav_row.append(InlineKeyboardButton(
+            text="◀️", callback_data=f"keys:{key_filter}:prev:{page['keys'][0]['id']}"
+        ))
+    if page['has_next']:
+        nav_row.append(InlineKeyboardButton(
+            text="▶️", callback_data=f"keys:{key_filter}:next:{page['keys'][-1]['id']}"
+        ))
+    kb = [filter_row]
+    if nav_row:
+        kb.append(nav_row)
+    return InlineKeyboardMarkup(inline_keyboard=kb)
+
+
+async def render_keys_page(key_filter='all', direction='first', cursor=None):
+    status_filter = KEYS_FILTERS[key_filter][1]
+    if direction == 'next':
+        page = await db.get_keys_page(after_id=cursor, limit=KEYS_PAGE_SIZE, status_filter=status_filter)
+    elif direction == 'prev':
+        page = await db.get_keys_page(before_id=cursor, limit=KEYS_PAGE_SIZE, status_filter=status_filter)
+    else:
+        page = await db.get_keys_page(limit=KEYS_PAGE_SIZE, status_filter=status_filter)
+    
+    stats = await db.get_statistics()
+    
+    text = f"🔑 Ключи: {KEYS_FILTERS[key_filter][0].lower()}\n"
+    text += f"✅ Доступно ключей: {stats['available_keys']}\n\n"
+    if not page['keys']:
+        text += "Ключей нет"
+    for key in page['keys']:
         status = "✅" if key['is_used'] == 0 else "❌"
         text += f"{status} {key['key_value']}\n"
     
-    if len(keys) > 20:
-        text += f"\n... и ещё {len(keys) - 20}"
+    return text, keys_page_kb(page, key_filter)
+
+
+@router.message(Command("listkeys"))
+async def list_keys(message: Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    
+    text, kb = await render_keys_page()
+    await message.answer(text, reply_markup=kb)
+
+
+@router.callback_query(F.data.startswith("keys:"))
+async def list_keys_page(callback: CallbackQuery):
+    if callback.from_user.id not in ADMIN_IDS:
+        await callback.answer("❌ Доступ запрещён", show_alert=True)
+        return
+    
+    parts = callback.data.split(":")
+    key_filter = parts[1] if parts[1] in KEYS_FILTERS else 'all'
+    direction = parts[2]
+    cursor = int(parts[3]) if len(parts) > 3 else None
+    
+    text, kb = await render_keys_page(key_filter, direction, cursor)
+    await callback.message.edit_text(text, reply_markup=kb)
+    await callback.answer()
+
+
+@router.message(Command("export"))
+async def export_data(message: Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    
+    usage = (
+        "Использование: /export <таблица> [csv|jsonl] [с YYYY-MM-DD] [по YYYY-MM-DD]\n"
+        f"Таблицы: {', '.join(sorted(EXPORT_TABLES))}"
+    )
+    args = message.text.split()[1:]
+    if not args or args[0] not in EXPORT_TABLES:
+        await message.answer(usage)
+        return
+    
+    table = args[0]
+    fmt = args[1] if len(args) > 1 else 'csv'
+    if fmt not in EXPORT_FORMATS:
+        await message.answer(usage)
+        return
+    date_from = args[2] if len(args) > 2 else None
+    date_to = args[3] if len(args) > 3 else None
+    
+    status_message = await message.answer(f"⏳ Выгрузка {table}...")
     
-    await message.answer(text)
+    spawn_background(export_task(status_message, table, fmt, date_from, date_to))
+
+
+async def export_task(status_message: Message, table, fmt, date_from, date_to):
+    filename = export_filename(table, fmt, compress=True)
+    path = os.path.join(tempfile.gettempdir(), filename)
+    try:
+        count = await db.export_table(
+            table, path, fmt=fmt, compress=True,
+            date_from=date_from, date_to=date_to
+        )
+        await status_message.answer_document(
+            FSInputFile(path, filename=filename),
+            caption=f"📤 {table}: {count} строк"
+        )
+        await status_message.delete()
+    except Exception as e:
+        logger.error(f"Ошибка выгрузки {table}: {e}")
+        await status_message.edit_text(f"❌ Ошибка выгрузки {table}")
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
 
 
 # ============= ЗАПУСК БОТА =============
 
+async def log_retention_loop():
+    """Периодический перенос старых логов в архив"""
+    # При шардировании у каждого файла своя таблица logs и свой архив
+    databases = db.db.get_databases()
+    retentions = [
+        retention_from_env(database, per_database=len(databases) > 1) for database in databases
+    ]
+    while True:
+        for retention in retentions:
+            try:
+                await db.run_log_retention(retention)
+            except Exception as e:
+                logger.error(f"Ошибка ретеншна логов {retention.db.db_path}: {e}")
+        await asyncio.sleep(LOG_RETENTION_INTERVAL)
+
+
+async def order_expiry_loop():
+    """Периодическое истечение брошенных заказов"""
+    outbound_priority.set(PRIORITY_NOTIFICATION)
+    while True:
+        try:
+            expired = await db.expire_stale_orders(ORDER_TTL, PENDING_ORDER_TTL)
+            if expired:
+                logger.info(f"Истекло заказов: {len(expired)}")
+            if NOTIFY_EXPIRED_ORDERS:
+                for order in expired:
+                    try:
+                        await bot.send_message(
+                            order['user_id'],
+                            expired_order_text(order),
+                            reply_markup=main_menu_kb()
+                        )
+                    except Exception as e:
+                        logger.error(f"Ошибка уведомления об истечении заказа {order['id']}: {e}")
+        except Exception as e:
+            logger.error(f"Ошибка истечения заказов: {e}")
+        await asyncio.sleep(ORDER_SWEEP_INTERVAL)
+
+
+async def backup_loop():
+    """Периодический горячий бэкап базы"""
+    manager = backup_from_env(db.db)
+    while True:
+        await asyncio.sleep(BACKUP_INTERVAL)
+        try:
+            snapshots = await db.run_backup(manager)
+            logger.info(f"Бэкап готов: {', '.join(snapshots)}")
+        except Exception as e:
+            logger.error(f"Ошибка бэкапа: {e}")
+
+
+async def run_webhook():
+    """Приём апдейтов через вебхук (RUN_MODE=webhook или local)"""
+    server = webhook_from_env(dp, bot, metrics=outbound.stats)
+    webhook_url = None
+    if RUN_MODE == 'webhook':
+        if not WEBHOOK_URL:
+            raise RuntimeError("Для RUN_MODE=webhook нужен WEBHOOK_URL")
+        # Без секрета любой, кто знает URL, может прислать поддельный апдейт
+        if not server.secret_token:
+            raise RuntimeError("Для RUN_MODE=webhook нужен WEBHOOK_SECRET")
+        webhook_url = WEBHOOK_URL + server.path
+    await server.serve(
+        WEBAPP_HOST, WEBAPP_PORT,
+        webhook_url=webhook_url,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+    )
+
+
 async def main():
-    db.init_db()
+    await db.init_db()
     dp.include_router(router)
-    
-    logger.info("Бот запущен")
-    await dp.start_polling(bot)
+    # Очередь уведомлений досылается до закрытия сессии бота
+    dp.shutdown.register(notifier.close)
+    dp.shutdown.register(outbound.close)
+    
+    jobs = []
+    if BACKGROUND_JOBS:
+        jobs.append(asyncio.create_task(log_retention_loop()))
+        jobs.append(asyncio.create_task(order_expiry_loop()))
+        if BACKUP_INTERVAL:
+            jobs.append(asyncio.create_task(backup_loop()))
+    
+    logger.info(f"Бот запущен ({RUN_MODE})")
+    try:
+        if RUN_MODE in ('webhook', 'local'):
+            await run_webhook()
+        else:
+            await dp.start_polling(bot)
+    finally:
+        for job in jobs:
+            job.cancel()
+        db.close()
 
 
 if __name__ == '__main__':
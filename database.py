@@ -1,125 +1,612 @@
 import sqlite3
+import threading
 from datetime import datetime
 import logging
 
+from audit_log import AuditLogWriter
+from key_generator import KeyBloomFilter, KeyCodec
+from user_cache import KnownUsersCache
+
 logger = logging.getLogger(__name__)
 
+# Результаты выдачи ключа по заказу (claim_key_for_order)
+CLAIM_OK = 'ok'
+CLAIM_NOT_FOUND = 'not_found'
+CLAIM_ALREADY_CONFIRMED = 'already_confirmed'
+CLAIM_OUT_OF_STOCK = 'out_of_stock'
+CLAIM_INVALID_STATUS = 'invalid_status'
+CLAIM_ERROR = 'error'
+
+# Статусы заказа и допустимые переходы: новый статус -> из каких можно перейти
+# created -> pending -> confirmed / rejected / expired
+# В confirmed заказ переводит только claim_key_for_order - вместе с выдачей ключа
+ORDER_STATUSES = ('created', 'pending', 'confirmed', 'rejected', 'expired')
+ORDER_TRANSITIONS = {
+    'pending': ('created',),
+    'rejected': ('created', 'pending'),
+    'expired': ('created', 'pending'),
+}
+
+
+class InvalidTransition:
+    """
+    Результат недопустимого перехода статуса заказа
+    
+    В логическом контексте ложен, поэтому обработчик может писать
+    `if not result:`. current_status равен None, если заказа нет.
+    """
+    
+    def __init__(self, order_id, status, current_status=None):
+        self.order_id = order_id
+        self.status = status
+        self.current_status = current_status
+    
+    @property
+    def not_found(self):
+        return self.current_status is None
+    
+    def __bool__(self):
+        return False
+    
+    def __repr__(self):
+        return (f"InvalidTransition(order_id={self.order_id}, "
+                f"status={self.status!r}, current_status={self.current_status!r})")
+
+
+# Полный пересчёт счётчиков статистики (миграция 3 и reconcile_statistics)
+STATS_RECONCILE_SQL = '''
+    INSERT OR REPLACE INTO stats
+        (id, total_users, total_sales, total_revenue, available_keys, pending_orders)
+    SELECT
+        1,
+        (SELECT COUNT(*) FROM users),
+        (SELECT COUNT(*) FROM orders WHERE status = 'confirmed'),
+        (SELECT COALESCE(SUM(amount), 0) FROM orders WHERE status = 'confirmed'),
+        (SELECT COUNT(*) FROM keys WHERE is_used = 0),
+        (SELECT COUNT(*) FROM orders WHERE status = 'pending')
+'''
+
+# Таблицы, доступные для выгрузки, и столбец даты для фильтра по периоду
+EXPORT_TABLES = {
+    'keys': 'created_at',
+    'orders': 'created_at',
+    'purchases': 'purchase_date',
+    'logs': 'created_at',
+}
+
+# ============= МИГРАЦИИ =============
+# Список (версия, описание, [SQL]). Новые изменения схемы добавляются
+# только в конец списка с увеличением версии, старые шаги не редактируются.
+
+MIGRATIONS = [
+    (1, 'Базовая схема', [
+        # Таблица пользователей
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY,
+            telegram_id INTEGER UNIQUE NOT NULL,
+            username TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        # Таблица ключей
+        '''
+        CREATE TABLE IF NOT EXISTS keys (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            key_value TEXT UNIQUE NOT NULL,
+            is_used INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        # Таблица заказов
+        '''
+        CREATE TABLE IF NOT EXISTS orders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            amount REAL NOT NULL,
+            status TEXT DEFAULT 'created',
+            key_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            confirmed_at TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(telegram_id),
+            FOREIGN KEY (key_id) REFERENCES keys(id)
+        )
+        ''',
+        # Таблица покупок (история)
+        '''
+        CREATE TABLE IF NOT EXISTS purchases (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            order_id INTEGER NOT NULL,
+            key_id INTEGER NOT NULL,
+            purchase_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(telegram_id),
+            FOREIGN KEY (order_id) REFERENCES orders(id),
+            FOREIGN KEY (key_id) REFERENCES keys(id)
+        )
+        ''',
+        # Таблица логов
+        '''
+        CREATE TABLE IF NOT EXISTS logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            action TEXT NOT NULL,
+            details TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ]),
+    (2, 'Индексы для горячих запросов', [
+        # Свободные ключи: WHERE is_used = 0 ORDER BY id
+        'CREATE INDEX IF NOT EXISTS idx_keys_free ON keys(id) WHERE is_used = 0',
+        # Заказы по статусу: WHERE status = ? ORDER BY created_at
+        'CREATE INDEX IF NOT EXISTS idx_orders_status ON orders(status, created_at)',
+        # Покупки пользователя: WHERE user_id = ? ORDER BY purchase_date
+        'CREATE INDEX IF NOT EXISTS idx_purchases_user ON purchases(user_id, purchase_date, key_id)',
+        # Логи: по пользователю и по времени
+        'CREATE INDEX IF NOT EXISTS idx_logs_user ON logs(user_id, created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_logs_created ON logs(created_at)',
+    ]),
+    (3, 'Счётчики статистики на триггерах', [
+        '''
+        CREATE TABLE IF NOT EXISTS stats (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            total_users INTEGER NOT NULL DEFAULT 0,
+            total_sales INTEGER NOT NULL DEFAULT 0,
+            total_revenue REAL NOT NULL DEFAULT 0,
+            available_keys INTEGER NOT NULL DEFAULT 0,
+            pending_orders INTEGER NOT NULL DEFAULT 0
+        )
+        ''',
+        # Начальные значения считаются один раз по текущим данным
+        STATS_RECONCILE_SQL,
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_stats_users_insert AFTER INSERT ON users
+        BEGIN
+            UPDATE stats SET total_users = total_users + 1 WHERE id = 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_stats_users_delete AFTER DELETE ON users
+        BEGIN
+            UPDATE stats SET total_users = total_users - 1 WHERE id = 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_stats_keys_insert AFTER INSERT ON keys
+        BEGIN
+            UPDATE stats SET available_keys = available_keys + (NEW.is_used IS 0) WHERE id = 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_stats_keys_update AFTER UPDATE OF is_used ON keys
+        BEGIN
+            UPDATE stats
+            SET available_keys = available_keys + (NEW.is_used IS 0) - (OLD.is_used IS 0)
+            WHERE id = 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_stats_keys_delete AFTER DELETE ON keys
+        BEGIN
+            UPDATE stats SET available_keys = available_keys - (OLD.is_used IS 0) WHERE id = 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_stats_orders_insert AFTER INSERT ON orders
+        BEGIN
+            UPDATE stats
+            SET total_sales = total_sales + (NEW.status IS 'confirmed'),
+                total_revenue = total_revenue
+                    + CASE WHEN NEW.status IS 'confirmed' THEN NEW.amount ELSE 0 END,
+                pending_orders = pending_orders + (NEW.status IS 'pending')
+            WHERE id = 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_stats_orders_update AFTER UPDATE OF status, amount ON orders
+        BEGIN
+            UPDATE stats
+            SET total_sales = total_sales
+                    + (NEW.status IS 'confirmed') - (OLD.status IS 'confirmed'),
+                total_revenue = total_revenue
+                    + CASE WHEN NEW.status IS 'confirmed' THEN NEW.amount ELSE 0 END
+                    - CASE WHEN OLD.status IS 'confirmed' THEN OLD.amount ELSE 0 END,
+                pending_orders = pending_orders
+                    + (NEW.status IS 'pending') - (OLD.status IS 'pending')
+            WHERE id = 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_stats_orders_delete AFTER DELETE ON orders
+        BEGIN
+            UPDATE stats
+            SET total_sales = total_sales - (OLD.status IS 'confirmed'),
+                total_revenue = total_revenue
+                    - CASE WHEN OLD.status IS 'confirmed' THEN OLD.amount ELSE 0 END,
+                pending_orders = pending_orders - (OLD.status IS 'pending')
+            WHERE id = 1;
+        END
+        ''',
+    ]),
+    (4, 'Дневные агрегаты логов для ретеншна', [
+        '''
+        CREATE TABLE IF NOT EXISTS logs_daily (
+            day TEXT NOT NULL,
+            action TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, action)
+        ) WITHOUT ROWID
+        ''',
+    ]),
+    (5, 'Индекс открытых заказов пользователя', [
+        'CREATE INDEX IF NOT EXISTS idx_orders_user_status ON orders(user_id, status)',
+    ]),
+    (6, 'Счётчик ключей, выводимых по номеру', [
+        '''
+        CREATE TABLE IF NOT EXISTS key_sequence (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            next_index INTEGER NOT NULL DEFAULT 0
+        )
+        ''',
+        'INSERT OR IGNORE INTO key_sequence (id, next_index) VALUES (1, 0)',
+    ]),
+    (7, 'Служебные параметры базы (кодек упакованных ключей)', [
+        '''
+        CREATE TABLE IF NOT EXISTS meta (
+            name TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        )
+        ''',
+    ]),
+]
+
 
 class Database:
-    def __init__(self, db_path='bot_database.db'):
+    # Настройки соединения, применяются один раз при открытии.
+    # auto_vacuum действует только на новую пустую базу и должен идти
+    # до journal_mode: переключение в WAL уже записывает заголовок файла
+    PRAGMAS = (
+        ('auto_vacuum', 'INCREMENTAL'),
+        ('journal_mode', 'WAL'),
+        ('synchronous', 'NORMAL'),
+        ('busy_timeout', 5000),
+        ('mmap_size', 256 * 1024 * 1024),
+        ('cache_size', -16000),  # ~16 МБ
+        ('temp_store', 'MEMORY'),
+    )
+    
+    def __init__(self, db_path='bot_database.db', buffered_logs=True, known_users_cache_size=100000,
+                 key_codec=None, key_deriver=None):
+        """
+        Args:
+            db_path: Путь к файлу базы данных
+            buffered_logs: Писать логи пачками в фоновом потоке (AuditLogWriter)
+            known_users_cache_size: Размер кэша известных пользователей (0 - без кэша)
+            key_codec: KeyCodec для компактного хранения ключей (None - хранить текстом)
+            key_deriver: KeyGenerator с derive_secret - когда пул пуст, ключ
+                выводится по номеру из key_sequence прямо при выдаче
+        """
         self.db_path = db_path
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self.log_writer = AuditLogWriter(self) if buffered_logs else None
+        self.known_users = KnownUsersCache(known_users_cache_size) if known_users_cache_size else None
+        self.key_codec = key_codec
+        self.key_deriver = key_deriver
     
-    def get_connection(self):
-        conn = sqlite3.connect(self.db_path)
+    def _open_connection(self):
+        """Открытие нового соединения с настройкой PRAGMA"""
+        conn = sqlite3.connect(self.db_path, timeout=5, check_same_thread=False)
         conn.row_factory = sqlite3.Row
+        for name, value in self.PRAGMAS:
+            conn.execute(f'PRAGMA {name} = {value}')
+        return conn
+    
+    def get_connection(self):
+        """
+        Постоянное соединение текущего потока
+        
+        Соединение открывается один раз на поток и переиспользуется всеми
+        методами. Закрывать его не нужно, для транзакций используйте
+        `with conn:` (commit/rollback без закрытия).
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._open_connection()
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
         return conn
     
+    def close_thread_connection(self):
+        """Закрытие соединения текущего потока"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            return
+        self._local.conn = None
+        with self._connections_lock:
+            if conn in self._connections:
+                self._connections.remove(conn)
+        conn.close()
+    
+    def close(self):
+        """Сброс буфера логов и закрытие всех открытых соединений"""
+        if self.log_writer is not None:
+            self.log_writer.close()
+        with self._connections_lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            try:
+                conn.close()
+            except Exception as e:
+                logger.error(f"Ошибка закрытия соединения: {e}")
+        self._local = threading.local()
+    
+    def get_databases(self):
+        """
+        Все файлы базы, с которыми работает объект
+        
+        Для обслуживания (ретеншн, бэкап), которое выполняется по файлам.
+        """
+        return [self]
+    
     def init_db(self):
         """Инициализация базы данных"""
+        self.migrate()
+        self._check_auto_vacuum()
+        self._sync_key_codec()
+        self.warm_user_cache()
+        logger.info("База данных инициализирована")
+    
+    def _check_auto_vacuum(self):
+        """Предупреждение для базы, созданной до включения auto_vacuum"""
         conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        # Таблица пользователей
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY,
-                telegram_id INTEGER UNIQUE NOT NULL,
-                username TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+            logger.warning(
+                f"{self.db_path}: auto_vacuum выключен, ретеншн не будет уменьшать файл. "
+                f"Однократно выполните: python retention.py --db {self.db_path} --enable-incremental-vacuum"
             )
-        ''')
-        
-        # Таблица ключей
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS keys (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                key_value TEXT UNIQUE NOT NULL,
-                is_used INTEGER DEFAULT 0,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    
+    def get_schema_version(self):
+        """Текущая версия схемы (0 для пустой базы)"""
+        conn = self.get_connection()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                description TEXT,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         ''')
+        row = conn.execute('SELECT MAX(version) as version FROM schema_version').fetchone()
+        return row['version'] or 0
+    
+    def migrate(self):
+        """
+        Применение недостающих миграций из MIGRATIONS по порядку
         
-        # Таблица заказов
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS orders (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                amount REAL NOT NULL,
-                status TEXT DEFAULT 'created',
-                key_id INTEGER,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                confirmed_at TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users(telegram_id),
-                FOREIGN KEY (key_id) REFERENCES keys(id)
-            )
-        ''')
+        Каждая миграция выполняется в своей транзакции вместе с записью
+        в schema_version, поэтому прерванный запуск можно просто повторить.
         
-        # Таблица покупок (история)
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS purchases (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                order_id INTEGER NOT NULL,
-                key_id INTEGER NOT NULL,
-                purchase_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users(telegram_id),
-                FOREIGN KEY (order_id) REFERENCES orders(id),
-                FOREIGN KEY (key_id) REFERENCES keys(id)
-            )
-        ''')
+        Returns:
+            int: Версия схемы после миграции
+        """
+        conn = self.get_connection()
+        current = self.get_schema_version()
         
-        # Таблица логов
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS logs (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                action TEXT NOT NULL,
-                details TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+        for version, description, statements in MIGRATIONS:
+            if version <= current:
+                continue
+            with conn:
+                conn.execute('BEGIN IMMEDIATE')
+                # Другой процесс мог успеть применить миграцию
+                applied = conn.execute(
+                    'SELECT 1 FROM schema_version WHERE version = ?', (version,)
+                ).fetchone()
+                if applied:
+                    continue
+                for statement in statements:
+                    conn.execute(statement)
+                conn.execute(
+                    'INSERT INTO schema_version (version, description) VALUES (?, ?)',
+                    (version, description)
+                )
+            logger.info(f"Применена миграция {version}: {description}")
+            current = version
         
-        conn.commit()
-        conn.close()
-        logger.info("База данных инициализирована")
+        return current
     
     # ============= ПОЛЬЗОВАТЕЛИ =============
     
     def add_user(self, telegram_id, username):
-        """Добавление пользователя"""
+        """
+        Добавление пользователя
+        
+        Уже известные пользователи (есть в кэше) не трогают базу, а запись
+        user_registered пишется только при реальной регистрации.
+        """
+        if self.known_users is not None and telegram_id in self.known_users:
+            return
         try:
             conn = self.get_connection()
-            cursor = conn.cursor()
-            cursor.execute(
-                'INSERT OR IGNORE INTO users (telegram_id, username) VALUES (?, ?)',
-                (telegram_id, username)
-            )
-            conn.commit()
-            conn.close()
-            self.log_action(telegram_id, 'user_registered', f'Username: {username}')
+            with conn:
+                cursor = conn.execute(
+                    'INSERT OR IGNORE INTO users (telegram_id, username) VALUES (?, ?)',
+                    (telegram_id, username)
+                )
+            if self.known_users is not None:
+                self.known_users.add(telegram_id)
+            if cursor.rowcount:
+                self.log_action(telegram_id, 'user_registered', f'Username: {username}')
         except Exception as e:
             logger.error(f"Ошибка добавления пользователя: {e}")
     
+    def warm_user_cache(self):
+        """Загрузка последних пользователей в кэш известных пользователей"""
+        if self.known_users is None:
+            return
+        conn = self.get_connection()
+        cursor = conn.execute(
+            '''SELECT telegram_id FROM (
+                   SELECT id, telegram_id FROM users ORDER BY id DESC LIMIT ?
+               ) ORDER BY id''',
+            (self.known_users.max_size,)
+        )
+        self.known_users.update(row['telegram_id'] for row in cursor)
+        logger.info(f"Кэш пользователей прогрет: {len(self.known_users)}")
+    
     def get_user(self, telegram_id):
         """Получение пользователя"""
         conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM users WHERE telegram_id = ?', (telegram_id,))
+        cursor = conn.execute('SELECT * FROM users WHERE telegram_id = ?', (telegram_id,))
         user = cursor.fetchone()
-        conn.close()
         return dict(user) if user else None
     
     # ============= КЛЮЧИ =============
     
+    def encode_key(self, key_value):
+        """
+        Значение ключа для записи в keys.key_value
+        
+        В компактном режиме ключи по шаблону хранятся как BLOB, остальные
+        (например, ключи поставщиков) - как обычный текст.
+        """
+        if self.key_codec is None or not isinstance(key_value, str):
+            return key_value
+        blob = self.key_codec.encode(key_value)
+        return blob if blob is not None else key_value
+    
+    def decode_key(self, stored):
+        """Текстовый ключ из значения keys.key_value"""
+        if isinstance(stored, bytes):
+            if self.key_codec is None:
+                raise ValueError("Ключ хранится в компактном виде, но key_codec не задан")
+            return self.key_codec.decode(stored)
+        return stored
+    
+    def _key_row(self, row):
+        """Строка keys как dict с раскодированным key_value"""
+        key = dict(row)
+        if 'key_value' in key:
+            key['key_value'] = self.decode_key(key['key_value'])
+        return key
+    
+    def _sync_key_codec(self):
+        """
+        Сверка key_codec с кодеком, которым упакованы ключи в базе
+        
+        Параметры кодека хранятся в meta. Если шаблон или алфавит сменились
+        или компактный режим выключен, ключи сначала распаковываются прежним
+        кодеком: иначе decode_key молча вернул бы другие, похожие на
+        настоящие ключи. Затем ключи упаковываются текущим кодеком.
+        """
+        conn = self.get_connection()
+        row = conn.execute("SELECT value FROM meta WHERE name = 'key_codec'").fetchone()
+        stored = row['value'] if row else None
+        current = self.key_codec.dumps() if self.key_codec is not None else None
+        has_blobs = conn.execute(
+            "SELECT 1 FROM keys WHERE typeof(key_value) = 'blob' LIMIT 1"
+        ).fetchone() is not None
+        
+        if stored != current and has_blobs:
+            if stored is not None:
+                expanded = self.expand_stored_keys(codec=KeyCodec.loads(stored))
+                logger.warning(f"{self.db_path}: шаблон ключей изменился, распаковано {expanded} ключей")
+            elif self.key_codec is None:
+                raise RuntimeError(
+                    f"{self.db_path}: ключи хранятся упакованными, запустите с KEY_STORAGE=compact"
+                )
+            else:
+                # Ключи упакованы до появления meta: прежний кодек неизвестен
+                logger.warning(f"{self.db_path}: кодек упакованных ключей не записан, считаем его текущим")
+        
+        with conn:
+            if current is None:
+                conn.execute("DELETE FROM meta WHERE name = 'key_codec'")
+            else:
+                conn.execute(
+                    "INSERT OR REPLACE INTO meta (name, value) VALUES ('key_codec', ?)", (current,)
+                )
+        if self.key_codec is not None:
+            self.compact_stored_keys()
+    
+    def compact_stored_keys(self, batch_size=5000):
+        """
+        Перевод уже сохранённых текстовых ключей в компактный вид
+        
+        Идёт пачками по id, чтобы не держать блокировку записи долго.
+        Ключи не по шаблону остаются текстом.
+        
+        Returns:
+            int: Количество упакованных ключей
+        """
+        if self.key_codec is None:
+            return 0
+        conn = self.get_connection()
+        packed = 0
+        last_id = 0
+        while True:
+            rows = conn.execute(
+                '''SELECT id, key_value FROM keys
+                   WHERE id > ? AND typeof(key_value) = 'text'
+                   ORDER BY id LIMIT ?''',
+                (last_id, batch_size)
+            ).fetchall()
+            if not rows:
+                break
+            last_id = rows[-1]['id']
+            updates = []
+            for row in rows:
+                blob = self.key_codec.encode(row['key_value'])
+                if blob is not None:
+                    updates.append((blob, row['id']))
+            if updates:
+                with conn:
+                    cursor = conn.executemany('UPDATE OR IGNORE keys SET key_value = ? WHERE id = ?', updates)
+                packed += cursor.rowcount
+        if packed:
+            logger.info(f"Упаковано ключей: {packed}")
+        return packed
+    
+    def expand_stored_keys(self, batch_size=5000, codec=None):
+        """
+        Обратный перевод упакованных ключей в текст
+        
+        Args:
+            batch_size: Размер пачки
+            codec: KeyCodec, которым ключи были упакованы (по умолчанию key_codec)
+        
+        Returns:
+            int: Количество распакованных ключей
+        """
+        decode = codec.decode if codec is not None else self.decode_key
+        conn = self.get_connection()
+        expanded = 0
+        while True:
+            rows = conn.execute(
+                "SELECT id, key_value FROM keys WHERE typeof(key_value) = 'blob' LIMIT ?",
+                (batch_size,)
+            ).fetchall()
+            if not rows:
+                break
+            with conn:
+                conn.executemany(
+                    'UPDATE keys SET key_value = ? WHERE id = ?',
+                    [(decode(row['key_value']), row['id']) for row in rows]
+                )
+            expanded += len(rows)
+        return expanded
+    
     def add_key(self, key_value):
         """Добавление ключа"""
         try:
             conn = self.get_connection()
-            cursor = conn.cursor()
-            cursor.execute('INSERT INTO keys (key_value) VALUES (?)', (key_value,))
-            conn.commit()
+            with conn:
+                cursor = conn.execute(
+                    'INSERT INTO keys (key_value) VALUES (?)', (self.encode_key(key_value),)
+                )
             key_id = cursor.lastrowid
-            conn.close()
             self.log_action(None, 'key_added', f'Key: {key_value}')
             return key_id
         except sqlite3.IntegrityError:
@@ -129,198 +616,591 @@ class Database:
             logger.error(f"Ошибка добавления ключа: {e}")
             return None
     
+    def add_keys_bulk(self, key_values, chunk_size=1000, progress=None):
+        """
+        Массовое добавление ключей
+        
+        Ключи вставляются через INSERT OR IGNORE пачками по chunk_size,
+        каждая пачка в своей транзакции. Вместо лога на каждый ключ пишется
+        одна итоговая запись.
+        
+        Args:
+            key_values: Итерируемый набор ключей (можно генератор)
+            chunk_size: Размер пачки
+            progress: Необязательный callback(processed, inserted) после каждой пачки
+            
+        Returns:
+            dict: {'inserted': int, 'duplicates': int}
+        """
+        inserted = 0
+        processed = 0
+        
+        def flush(chunk):
+            nonlocal inserted, processed
+            inserted += self.insert_keys(chunk)
+            processed += len(chunk)
+            if progress is not None:
+                progress(processed, inserted)
+        
+        chunk = []
+        for key_value in key_values:
+            chunk.append(key_value)
+            if len(chunk) >= chunk_size:
+                flush(chunk)
+                chunk = []
+        if chunk:
+            flush(chunk)
+        
+        duplicates = processed - inserted
+        self.log_action(None, 'keys_bulk_added', f'Inserted: {inserted}, Duplicates: {duplicates}')
+        return {'inserted': inserted, 'duplicates': duplicates}
+    
+    def insert_keys(self, key_values):
+        """
+        Вставка пачки ключей одной транзакцией, без записи в лог
+        
+        Returns:
+            int: Количество вставленных (не дубликатов)
+        """
+        conn = self.get_connection()
+        with conn:
+            # rowcount, а не total_changes: тот учитывает и строки,
+            # изменённые триггерами статистики
+            cursor = conn.executemany(
+                'INSERT OR IGNORE INTO keys (key_value) VALUES (?)',
+                ((self.encode_key(key_value),) for key_value in key_values)
+            )
+        return cursor.rowcount
+    
+    def existing_keys(self, key_values, batch_size=500):
+        """
+        Какие из ключей уже есть в базе
+        
+        Args:
+            key_values: Ключи для проверки
+            batch_size: Размер пачки запроса IN (...)
+            
+        Returns:
+            set: Ключи из key_values, найденные в keys
+        """
+        conn = self.get_connection()
+        key_values = list(key_values)
+        found = set()
+        for start in range(0, len(key_values), batch_size):
+            batch = [self.encode_key(key_value) for key_value in key_values[start:start + batch_size]]
+            rows = conn.execute(
+                f'SELECT key_value FROM keys WHERE key_value IN ({",".join("?" * len(batch))})',
+                batch
+            ).fetchall()
+            found.update(self.decode_key(row['key_value']) for row in rows)
+        return found
+    
+    def key_filter(self, extra=0, error_rate=0.001, batch_size=10000):
+        """
+        Фильтр Блума по всем ключам в базе
+        
+        Ключи читаются пачками по id, в памяти держится только сам фильтр.
+        Ключи, добавленные после построения фильтра, в него не попадают -
+        их нужно докладывать через update() (add_keys_bulk всё равно
+        пропустит конфликт через INSERT OR IGNORE).
+        
+        Args:
+            extra: Сколько ключей планируется добавить в фильтр сверх существующих
+            error_rate: Доля ложноположительных ответов
+            batch_size: Размер пачки чтения
+            
+        Returns:
+            KeyBloomFilter: Фильтр для KeyGenerator.generate_batch(exclude=...)
+        """
+        conn = self.get_connection()
+        total = conn.execute('SELECT COUNT(*) FROM keys').fetchone()[0]
+        key_filter = KeyBloomFilter(total + extra, error_rate)
+        last_id = 0
+        while True:
+            rows = conn.execute(
+                'SELECT id, key_value FROM keys WHERE id > ? ORDER BY id LIMIT ?',
+                (last_id, batch_size)
+            ).fetchall()
+            if not rows:
+                break
+            last_id = rows[-1]['id']
+            key_filter.update(self.decode_key(row['key_value']) for row in rows)
+        return key_filter
+    
     def get_next_available_key(self):
         """Получение следующего свободного ключа"""
         conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute(
+        cursor = conn.execute(
             'SELECT * FROM keys WHERE is_used = 0 ORDER BY id LIMIT 1'
         )
         key = cursor.fetchone()
-        conn.close()
-        return dict(key) if key else None
+        return self._key_row(key) if key else None
     
     def mark_key_as_used(self, key_id):
         """Пометить ключ как использованный"""
         conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('UPDATE keys SET is_used = 1 WHERE id = ?', (key_id,))
-        conn.commit()
-        conn.close()
+        with conn:
+            conn.execute('UPDATE keys SET is_used = 1 WHERE id = ?', (key_id,))
     
-    def get_available_keys_count(self):
-        """Количество доступных ключей"""
+    def get_available_keys_count(self, include_derived=False):
+        """
+        Количество доступных ключей
+        
+        Args:
+            include_derived: Учитывать ключи, которые ещё можно вывести
+                по счётчику (KEY_SOURCE=derived)
+        """
         conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT COUNT(*) as count FROM keys WHERE is_used = 0')
+        cursor = conn.execute('SELECT COUNT(*) as count FROM keys WHERE is_used = 0')
         count = cursor.fetchone()['count']
-        conn.close()
+        if include_derived:
+            count += self._derivable_keys(conn)
         return count
     
     def get_all_keys(self):
         """Получение всех ключей"""
         conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM keys ORDER BY id DESC')
-        keys = [dict(row) for row in cursor.fetchall()]
-        conn.close()
-        return keys
+        cursor = conn.execute('SELECT * FROM keys ORDER BY id DESC')
+        return [self._key_row(row) for row in cursor.fetchall()]
+    
+    def get_keys_page(self, after_id=None, limit=20, status_filter=None, before_id=None):
+        """
+        Страница ключей (от новых к старым) с keyset-пагинацией
+        
+        Вместо OFFSET используется граница по id, поэтому стоимость запроса
+        не зависит от номера страницы и размера таблицы.
+        
+        Args:
+            after_id: Вернуть ключи с id меньше указанного (следующая страница)
+            limit: Размер страницы
+            status_filter: None - все, 'unused' - свободные, 'used' - использованные
+            before_id: Вернуть ключи с id больше указанного (предыдущая страница)
+            
+        Returns:
+            dict: {'keys': list, 'has_next': bool, 'has_prev': bool}
+        """
+        conditions = []
+        if status_filter == 'unused':
+            conditions.append('is_used = 0')
+        elif status_filter == 'used':
+            conditions.append('is_used != 0')
+        
+        def where(*extra):
+            parts = conditions + list(extra)
+            return ('WHERE ' + ' AND '.join(parts)) if parts else ''
+        
+        conn = self.get_connection()
+        if before_id is not None:
+            rows = conn.execute(
+                f'SELECT * FROM keys {where("id > ?")} ORDER BY id ASC LIMIT ?',
+                [before_id, limit + 1]
+            ).fetchall()
+            has_prev = len(rows) > limit
+            keys = [self._key_row(row) for row in rows[:limit]][::-1]
+            has_next = True
+        else:
+            if after_id is not None:
+                rows = conn.execute(
+                    f'SELECT * FROM keys {where("id < ?")} ORDER BY id DESC LIMIT ?',
+                    [after_id, limit + 1]
+                ).fetchall()
+            else:
+                rows = conn.execute(
+                    f'SELECT * FROM keys {where()} ORDER BY id DESC LIMIT ?',
+                    [limit + 1]
+                ).fetchall()
+            has_next = len(rows) > limit
+            keys = [self._key_row(row) for row in rows[:limit]]
+            has_prev = False
+            if after_id is not None and keys:
+                has_prev = conn.execute(
+                    f'SELECT 1 FROM keys {where("id > ?")} LIMIT 1',
+                    [keys[0]['id']]
+                ).fetchone() is not None
+        
+        if not keys:
+            has_next = False
+        
+        return {'keys': keys, 'has_next': has_next, 'has_prev': has_prev}
     
     # ============= ЗАКАЗЫ =============
     
     def create_order(self, user_id, amount):
         """Создание заказа"""
         conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            'INSERT INTO orders (user_id, amount, status) VALUES (?, ?, ?)',
-            (user_id, amount, 'created')
-        )
+        with conn:
+            cursor = conn.execute(
+                'INSERT INTO orders (user_id, amount, status) VALUES (?, ?, ?)',
+                (user_id, amount, 'created')
+            )
+        order_id = cursor.lastrowid
+        self.log_action(user_id, 'order_created', f'Order ID: {order_id}, Amount: {amount}')
+        return order_id
+    
+    def get_or_create_open_order(self, user_id, amount, max_age=None):
+        """
+        Открытый заказ пользователя или новый
+        
+        Повторные нажатия "Купить" переиспользуют неоплаченный заказ
+        (status = 'created') с той же суммой вместо создания нового.
+        
+        Args:
+            user_id: Telegram ID пользователя
+            amount: Сумма заказа
+            max_age: Переиспользовать только заказы моложе N секунд (None - любые)
+            
+        Returns:
+            int: ID заказа
+        """
+        conn = self.get_connection()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            query = '''SELECT id FROM orders
+                       WHERE user_id = ? AND status = 'created' AND amount = ?'''
+            params = [user_id, amount]
+            if max_age is not None:
+                query += " AND created_at >= datetime('now', ?)"
+                params.append(f'-{int(max_age)} seconds')
+            row = conn.execute(query + ' ORDER BY id DESC LIMIT 1', params).fetchone()
+            if row:
+                return row['id']
+            
+            cursor = conn.execute(
+                'INSERT INTO orders (user_id, amount, status) VALUES (?, ?, ?)',
+                (user_id, amount, 'created')
+            )
         order_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
         self.log_action(user_id, 'order_created', f'Order ID: {order_id}, Amount: {amount}')
         return order_id
     
     def get_order(self, order_id):
         """Получение заказа"""
         conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM orders WHERE id = ?', (order_id,))
+        cursor = conn.execute('SELECT * FROM orders WHERE id = ?', (order_id,))
         order = cursor.fetchone()
-        conn.close()
         return dict(order) if order else None
     
-    def update_order_status(self, order_id, status):
-        """Обновление статуса заказа"""
+    def transition_order(self, order_id, status):
+        """
+        Переход заказа в новый статус по ORDER_TRANSITIONS
+        
+        Проверка текущего статуса и запись нового - один условный UPDATE,
+        поэтому поздний повторный запрос не может, например, вернуть
+        подтверждённый заказ в pending. Подтверждение заказа - только
+        через claim_key_for_order.
+        
+        Args:
+            order_id: ID заказа
+            status: Новый статус
+            
+        Returns:
+            dict | InvalidTransition: Обновлённый заказ или причина отказа
+        """
+        if status == 'confirmed':
+            raise ValueError("Заказ подтверждается только с выдачей ключа: claim_key_for_order")
+        if status not in ORDER_TRANSITIONS:
+            raise ValueError(f"Неизвестный статус заказа: {status}")
+        allowed = ORDER_TRANSITIONS[status]
+        placeholders = ', '.join('?' * len(allowed))
+        
         conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            'UPDATE orders SET status = ? WHERE id = ?',
-            (status, order_id)
-        )
-        conn.commit()
-        conn.close()
-        self.log_action(None, 'order_status_updated', f'Order ID: {order_id}, Status: {status}')
+        with conn:
+            order = conn.execute(
+                f'''UPDATE orders
+                    SET status = ?
+                    WHERE id = ? AND status IN ({placeholders})
+                    RETURNING *''',
+                (status, order_id, *allowed)
+            ).fetchone()
+        
+        if not order:
+            current = conn.execute(
+                'SELECT status FROM orders WHERE id = ?', (order_id,)
+            ).fetchone()
+            return InvalidTransition(order_id, status, current['status'] if current else None)
+        
+        self.log_action(order['user_id'], 'order_status_updated', f'Order ID: {order_id}, Status: {status}')
+        return dict(order)
+    
+    def update_order_status(self, order_id, status):
+        """Обновление статуса заказа (с проверкой перехода, см. transition_order)"""
+        return self.transition_order(order_id, status)
+    
+    def _claim_free_key(self, conn):
+        """Пометить первый свободный ключ использованным и вернуть его строку"""
+        key = conn.execute(
+            '''UPDATE keys SET is_used = 1
+               WHERE id = (SELECT id FROM keys WHERE is_used = 0 ORDER BY id LIMIT 1)
+               RETURNING *'''
+        ).fetchone()
+        if key or self.key_deriver is None:
+            return key
+        return self._mint_key(conn)
+    
+    def _mint_key(self, conn):
+        """
+        Вывод следующего ключа по счётчику key_sequence
+        
+        Ключ сразу записывается в keys как использованный, чтобы на него
+        могли ссылаться заказ и покупка. Номер, ключ которого уже есть в
+        таблице (например, загружен вручную), пропускается.
+        """
+        while True:
+            row = conn.execute(
+                '''UPDATE key_sequence SET next_index = next_index + 1 WHERE id = 1
+                   RETURNING next_index - 1 AS key_index'''
+            ).fetchone()
+            if row['key_index'] >= self.key_deriver.key_space:
+                return None
+            key_value = self.key_deriver.derive(row['key_index'])
+            key = conn.execute(
+                'INSERT OR IGNORE INTO keys (key_value, is_used) VALUES (?, 1) RETURNING *',
+                (self.encode_key(key_value),)
+            ).fetchone()
+            if key:
+                return key
+    
+    def _derivable_keys(self, conn):
+        """Сколько ключей ещё можно вывести по счётчику"""
+        if self.key_deriver is None:
+            return 0
+        row = conn.execute('SELECT next_index FROM key_sequence WHERE id = 1').fetchone()
+        return max(self.key_deriver.key_space - row['next_index'], 0)
+    
+    def _claim_failure_status(self, conn, order_id):
+        """Причина, по которой заказ нельзя подтвердить"""
+        current = conn.execute(
+            'SELECT status FROM orders WHERE id = ?', (order_id,)
+        ).fetchone()
+        if not current:
+            return CLAIM_NOT_FOUND
+        if current['status'] == 'confirmed':
+            return CLAIM_ALREADY_CONFIRMED
+        return CLAIM_INVALID_STATUS
     
-    def confirm_order(self, order_id, key_id):
-        """Подтверждение заказа и выдача ключа"""
+    def claim_key_for_order(self, order_id):
+        """
+        Атомарная выдача ключа по заказу
+        
+        В одной транзакции подтверждает заказ, резервирует первый свободный
+        ключ, привязывает его к заказу и записывает покупку. Два админа,
+        подтверждающие одновременно, не смогут выдать один ключ дважды.
+        
+        Args:
+            order_id: ID заказа
+            
+        Returns:
+            dict: {'status': CLAIM_*, 'order': dict | None, 'key': dict | None}
+        """
+        result = {'status': CLAIM_ERROR, 'order': None, 'key': None}
         try:
             conn = self.get_connection()
-            cursor = conn.cursor()
-            
-            # Получаем информацию о заказе
-            cursor.execute('SELECT user_id FROM orders WHERE id = ?', (order_id,))
-            order = cursor.fetchone()
-            if not order:
-                return False
-            
-            user_id = order['user_id']
-            
-            # Обновляем заказ
-            cursor.execute(
-                '''UPDATE orders 
-                   SET status = ?, key_id = ?, confirmed_at = CURRENT_TIMESTAMP 
-                   WHERE id = ?''',
-                ('confirmed', key_id, order_id)
-            )
-            
-            # Помечаем ключ как использованный
-            cursor.execute('UPDATE keys SET is_used = 1 WHERE id = ?', (key_id,))
-            
-            # Добавляем запись в покупки
-            cursor.execute(
-                'INSERT INTO purchases (user_id, order_id, key_id) VALUES (?, ?, ?)',
-                (user_id, order_id, key_id)
-            )
-            
-            conn.commit()
-            conn.close()
+            with conn:
+                # Сразу берём блокировку на запись, чтобы не ловить SQLITE_BUSY
+                # при повышении уровня блокировки посреди транзакции
+                conn.execute('BEGIN IMMEDIATE')
+                
+                order = conn.execute(
+                    '''UPDATE orders
+                       SET status = 'confirmed', confirmed_at = CURRENT_TIMESTAMP
+                       WHERE id = ? AND status IN ('created', 'pending')
+                       RETURNING *''',
+                    (order_id,)
+                ).fetchone()
+                if not order:
+                    conn.rollback()
+                    result['status'] = self._claim_failure_status(conn, order_id)
+                    return result
+                
+                key = self._claim_free_key(conn)
+                if not key:
+                    conn.rollback()
+                    result['status'] = CLAIM_OUT_OF_STOCK
+                    return result
+                
+                conn.execute(
+                    'UPDATE orders SET key_id = ? WHERE id = ?',
+                    (key['id'], order_id)
+                )
+                conn.execute(
+                    'INSERT INTO purchases (user_id, order_id, key_id) VALUES (?, ?, ?)',
+                    (order['user_id'], order_id, key['id'])
+                )
             
-            self.log_action(user_id, 'order_confirmed', f'Order ID: {order_id}, Key ID: {key_id}')
-            return True
+            result['order'] = dict(order)
+            result['order']['key_id'] = key['id']
+            result['key'] = self._key_row(key)
+            result['status'] = CLAIM_OK
+            self.log_action(order['user_id'], 'order_confirmed', f'Order ID: {order_id}, Key ID: {key["id"]}')
         except Exception as e:
-            logger.error(f"Ошибка подтверждения заказа: {e}")
-            return False
+            logger.error(f"Ошибка выдачи ключа по заказу {order_id}: {e}")
+        return result
+    
+    def expire_stale_orders(self, created_ttl=3600, pending_ttl=None, batch_size=500):
+        """
+        Перевод брошенных заказов в статус expired
+        
+        Заказы обновляются пачками по batch_size, каждая пачка - один
+        UPDATE ... RETURNING в своей транзакции.
+        
+        Args:
+            created_ttl: Срок жизни неоплаченного заказа, сек (None - не истекает)
+            pending_ttl: Срок жизни заказа на проверке, сек (None - не истекает)
+            batch_size: Размер пачки
+            
+        Returns:
+            list: Истёкшие заказы (dict с id, user_id, status до истечения)
+        """
+        conn = self.get_connection()
+        expired = []
+        for status, ttl in (('created', created_ttl), ('pending', pending_ttl)):
+            if not ttl:
+                continue
+            while True:
+                with conn:
+                    rows = conn.execute(
+                        '''UPDATE orders SET status = 'expired'
+                           WHERE id IN (
+                               SELECT id FROM orders
+                               WHERE status = ? AND created_at < datetime('now', ?)
+                               LIMIT ?
+                           )
+                           RETURNING id, user_id''',
+                        (status, f'-{int(ttl)} seconds', batch_size)
+                    ).fetchall()
+                expired.extend(dict(row, status=status) for row in rows)
+                if len(rows) < batch_size:
+                    break
+        
+        if expired:
+            self.log_action(None, 'orders_expired', f'Count: {len(expired)}')
+        return expired
     
     def get_pending_orders(self):
         """Получение заказов в ожидании"""
         conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute(
+        cursor = conn.execute(
             'SELECT * FROM orders WHERE status = ? ORDER BY created_at DESC',
             ('pending',)
         )
-        orders = [dict(row) for row in cursor.fetchall()]
-        conn.close()
-        return orders
+        return [dict(row) for row in cursor.fetchall()]
     
     # ============= ПОКУПКИ =============
     
     def get_user_purchases(self, user_id):
         """Получение покупок пользователя"""
         conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
+        cursor = conn.execute('''
             SELECT p.*, k.key_value 
             FROM purchases p
             JOIN keys k ON p.key_id = k.id
             WHERE p.user_id = ?
             ORDER BY p.purchase_date DESC
         ''', (user_id,))
-        purchases = [dict(row) for row in cursor.fetchall()]
-        conn.close()
-        return purchases
+        return [self._key_row(row) for row in cursor.fetchall()]
     
     # ============= СТАТИСТИКА =============
     
     def get_statistics(self):
-        """Получение статистики"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        """
+        Получение статистики
         
-        # Всего пользователей
-        cursor.execute('SELECT COUNT(*) as count FROM users')
-        total_users = cursor.fetchone()['count']
-        
-        # Всего продаж
-        cursor.execute('SELECT COUNT(*) as count FROM orders WHERE status = ?', ('confirmed',))
-        total_sales = cursor.fetchone()['count']
+        Счётчики хранятся в таблице stats и поддерживаются триггерами,
+        поэтому это чтение одной строки, а не пять проходов по таблицам.
+        """
+        conn = self.get_connection()
+        row = conn.execute(
+            '''SELECT total_users, total_sales, total_revenue, available_keys, pending_orders
+               FROM stats WHERE id = 1'''
+        ).fetchone()
+        if not row:
+            return self.reconcile_statistics()
+        stats = dict(row)
+        stats['available_keys'] += self._derivable_keys(conn)
+        return stats
+    
+    def reconcile_statistics(self):
+        """
+        Пересчёт счётчиков статистики с нуля по исходным таблицам
         
-        # Общая сумма
-        cursor.execute('SELECT SUM(amount) as total FROM orders WHERE status = ?', ('confirmed',))
-        total_revenue = cursor.fetchone()['total'] or 0
+        Returns:
+            dict: Статистика после пересчёта
+        """
+        conn = self.get_connection()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute(STATS_RECONCILE_SQL)
+        self.log_action(None, 'statistics_reconciled')
+        return self.get_statistics()
+    
+    # ============= ВЫГРУЗКА =============
+    
+    def iter_rows(self, table, date_from=None, date_to=None, batch_size=1000):
+        """
+        Потоковое чтение строк таблицы
         
-        # Доступно ключей
-        cursor.execute('SELECT COUNT(*) as count FROM keys WHERE is_used = 0')
-        available_keys = cursor.fetchone()['count']
+        Строки читаются пачками по id (keyset), поэтому память не зависит
+        от размера таблицы, а каждая пачка - короткий отдельный запрос.
         
-        # Ожидают подтверждения
-        cursor.execute('SELECT COUNT(*) as count FROM orders WHERE status = ?', ('pending',))
-        pending_orders = cursor.fetchone()['count']
+        Args:
+            table: Имя таблицы из EXPORT_TABLES
+            date_from: Нижняя граница даты (включительно), 'YYYY-MM-DD[ HH:MM:SS]'
+            date_to: Верхняя граница даты (не включительно)
+            batch_size: Размер пачки
+            
+        Yields:
+            dict: Строка таблицы
+        """
+        if table not in EXPORT_TABLES:
+            raise ValueError(f"Неизвестная таблица для выгрузки: {table}")
+        date_column = EXPORT_TABLES[table]
         
-        conn.close()
+        conditions = ['id > ?']
+        params = []
+        if date_from:
+            conditions.append(f'{date_column} >= ?')
+            params.append(date_from)
+        if date_to:
+            conditions.append(f'{date_column} < ?')
+            params.append(date_to)
+        query = (
+            f'SELECT * FROM {table} WHERE {" AND ".join(conditions)} '
+            f'ORDER BY id LIMIT ?'
+        )
         
-        return {
-            'total_users': total_users,
-            'total_sales': total_sales,
-            'total_revenue': total_revenue,
-            'available_keys': available_keys,
-            'pending_orders': pending_orders
-        }
+        conn = self.get_connection()
+        last_id = 0
+        while True:
+            rows = conn.execute(query, [last_id] + params + [batch_size]).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield self._key_row(row) if table == 'keys' else dict(row)
+            last_id = rows[-1]['id']
     
     # ============= ЛОГИ =============
     
     def log_action(self, user_id, action, details=''):
-        """Логирование действий"""
+        """
+        Логирование действий
+        
+        При включённом буфере событие только ставится в очередь, запись
+        в таблицу происходит пачкой в фоновом потоке.
+        """
+        if self.log_writer is not None:
+            self.log_writer.put(user_id, action, details)
+            return
         try:
             conn = self.get_connection()
-            cursor = conn.cursor()
-            cursor.execute(
-                'INSERT INTO logs (user_id, action, details) VALUES (?, ?, ?)',
-                (user_id, action, details)
-            )
-            conn.commit()
-            conn.close()
+            with conn:
+                conn.execute(
+                    'INSERT INTO logs (user_id, action, details) VALUES (?, ?, ?)',
+                    (user_id, action, details)
+                )
         except Exception as e:
-            logger.error(f"Ошибка логирования: {e}")
\ No newline at end of file
+            logger.error(f"Ошибка логирования: {e}")
+    
+    def flush_logs(self):
+        """Дождаться записи всех буферизованных логов"""
+        if self.log_writer is not None:
+            self.log_writer.flush()
\ No newline at end of file
@@ -0,0 +1,117 @@
+import argparse
+import csv
+import gzip
+import json
+import logging
+import os
+from datetime import datetime
+
+from database import EXPORT_TABLES
+from key_generator import key_generator_from_env
+from sharded_database import create_database
+
+logger = logging.getLogger(__name__)
+
+EXPORT_FORMATS = ('csv', 'jsonl')
+
+
+def export_filename(table, fmt='csv', compress=False):
+    """
+    Имя файла выгрузки
+
+    Returns:
+        str: Например keys_20240101_120000.csv.gz
+    """
+    name = f"{table}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{fmt}"
+    return name + '.gz' if compress else name
+
+
+def write_rows(rows, output, fmt='csv', compress=False):
+    """
+    Запись строк в файл CSV или JSONL
+
+    Строки пишутся по одной из итератора, в памяти держится только
+    текущая пачка чтения.
+
+    Args:
+        rows: Итератор словарей
+        output: Путь к файлу
+        fmt: 'csv' или 'jsonl'
+        compress: Сжимать gzip
+
+    Returns:
+        int: Количество записанных строк
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Неизвестный формат выгрузки: {fmt}")
+
+    opener = gzip.open if compress else open
+    count = 0
+    with opener(output, 'wt', encoding='utf-8', newline='') as f:
+        if fmt == 'jsonl':
+            for row in rows:
+                f.write(json.dumps(row, ensure_ascii=False, default=str))
+                f.write('\n')
+                count += 1
+        else:
+            writer = None
+            for row in rows:
+                if writer is None:
+                    writer = csv.DictWriter(f, fieldnames=list(row.keys()))
+                    writer.writeheader()
+                writer.writerow(row)
+                count += 1
+    return count
+
+
+def export_table(db, table, output, fmt='csv', compress=False, date_from=None, date_to=None):
+    """
+    Выгрузка таблицы в файл
+
+    Args:
+        db: Database или ShardedDatabase
+        table: Имя таблицы из EXPORT_TABLES
+        output: Путь к файлу
+        fmt: 'csv' или 'jsonl'
+        compress: Сжимать gzip
+        date_from: Нижняя граница даты (включительно)
+        date_to: Верхняя граница даты (не включительно)
+
+    Returns:
+        int: Количество выгруженных строк
+    """
+    rows = db.iter_rows(table, date_from=date_from, date_to=date_to)
+    count = write_rows(rows, output, fmt=fmt, compress=compress)
+    logger.info(f"Выгружено {count} строк из {table} в {output}")
+    return count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Выгрузка данных бота в CSV/JSONL')
+    parser.add_argument('table', choices=sorted(EXPORT_TABLES))
+    parser.add_argument('--db', help='Путь к базе данных')
+    parser.add_argument('--format', dest='fmt', choices=EXPORT_FORMATS, default='csv')
+    parser.add_argument('--gzip', action='store_true', help='Сжать выгрузку gzip')
+    parser.add_argument('--from', dest='date_from', help='С даты (включительно), YYYY-MM-DD')
+    parser.add_argument('--to', dest='date_to', help='По дату (не включительно), YYYY-MM-DD')
+    parser.add_argument('-o', '--output', help='Файл выгрузки (по умолчанию имя по таблице и времени)')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+
+    output = args.output or export_filename(args.table, args.fmt, args.gzip)
+    key_codec = key_generator_from_env().codec() if os.getenv('KEY_STORAGE') == 'compact' else None
+    db = create_database(args.db, buffered_logs=False, key_codec=key_codec)
+    try:
+        count = export_table(
+            db, args.table, output,
+            fmt=args.fmt, compress=args.gzip,
+            date_from=args.date_from, date_to=args.date_to
+        )
+    finally:
+        db.close()
+    print(f"{count} строк -> {output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,431 @@
-import random
+import hashlib
+import hmac
+import json
+import math
+import os
+import re
+import secrets
 import string
 
 
+class _CharTable:
+    """Перевод случайных байтов в символы алфавита без смещения"""
+    
+    def __init__(self, charset):
+        if not charset or len(charset) > 256 or not charset.isascii():
+            raise ValueError("charset должен состоять из 1-256 ASCII-символов")
+        # Байты >= limit отбрасываются, остальные -> charset[b % n]
+        n = len(charset)
+        self.limit = (256 // n) * n
+        encoded = charset.encode('ascii')
+        self.table = bytes(encoded[b % n] for b in range(256))
+        self.rejected = bytes(range(self.limit, 256))
+    
+    def random_chars(self, count):
+        chunks = []
+        have = 0
+        while have < count:
+            need = count - have
+            # Запас на отброшенные байты
+            raw = os.urandom(need * 256 // self.limit + 16)
+            chunk = raw.translate(self.table, self.rejected)
+            chunks.append(chunk)
+            have += len(chunk)
+        return b''.join(chunks)[:count]
+
+
+class BatchKeyEngine:
+    """
+    Пакетная генерация ключей из криптостойкой энтропии
+    
+    Случайные байты берутся из os.urandom большими блоками и переводятся в
+    символы charset одной таблицей bytes.translate: байты вне диапазона,
+    кратного len(charset), отбрасываются (rejection sampling, без смещения
+    распределения). Ключи собираются срезами bytearray по позициям шаблона,
+    так что на символ не приходится ни одной операции на Python.
+    """
+    
+    def __init__(self, format_pattern, charset, placeholder='X', charsets=None):
+        """
+        Args:
+            format_pattern: Шаблон ключа
+            charset: Алфавит случайных символов (ASCII, не больше 256 символов)
+            placeholder: Символ шаблона, заменяемый случайным
+            charsets: Необязательный словарь {символ шаблона: алфавит} для
+                шаблонов с разными алфавитами в разных позициях
+        """
+        if not format_pattern.isascii():
+            raise ValueError("Шаблон ключа должен состоять из ASCII-символов")
+        self.format_pattern = format_pattern
+        self.charset = charset
+        self.charsets = charsets or {placeholder: charset}
+        self.key_length = len(format_pattern)
+        
+        # Позиции с одинаковым алфавитом заполняются одной выборкой
+        self.groups = []
+        for slot, slot_charset in self.charsets.items():
+            positions = [i for i, char in enumerate(format_pattern) if char == slot]
+            if positions:
+                self.groups.append((positions, _CharTable(slot_charset)))
+        self.literals = [
+            (i, char.encode('ascii')) for i, char in enumerate(format_pattern)
+            if char not in self.charsets
+        ]
+    
+    def generate(self, count):
+        """
+        Генерация count ключей (без проверки уникальности)
+        
+        Returns:
+            list: Список ключей
+        """
+        if count <= 0:
+            return []
+        width = self.key_length + 1  # + перевод строки между ключами
+        out = bytearray(b'\n' * (width * count))
+        
+        for positions, table in self.groups:
+            per_key = len(positions)
+            chars = table.random_chars(per_key * count)
+            for j, position in enumerate(positions):
+                out[position::width] = chars[j::per_key]
+        for position, char in self.literals:
+            out[position::width] = char * count
+        
+        return out[:-1].decode('ascii').split('\n')
+    
+    def generate_unique(self, count, exclude=None, transform=None):
+        """
+        Генерация count уникальных ключей
+        
+        Args:
+            count: Количество ключей
+            exclude: Необязательный набор занятых ключей (поддерживающий in),
+                кандидаты из него отбрасываются и генерируются заново
+            transform: Необязательная функция над списком кандидатов,
+                применяется до проверки по exclude
+        
+        Returns:
+            list: Список уникальных ключей
+        """
+        keys = {}
+        while len(keys) < count:
+            candidates = self.generate(count - len(keys))
+            if transform is not None:
+                candidates = transform(candidates)
+            if exclude is not None:
+                candidates = [key for key in candidates if key not in exclude]
+            keys.update(dict.fromkeys(candidates))
+        return list(keys)
+
+
+class KeyBloomFilter:
+    """
+    Фильтр Блума по значениям ключей
+    
+    Компактная замена множеству уже существующих ключей: на миллион ключей
+    при error_rate=0.001 уходит ~1.8 МБ. Ложноотрицательных ответов не бывает,
+    поэтому кандидат, которого нет в фильтре, гарантированно не занят;
+    ложноположительный ответ лишь заставляет сгенерировать ещё один ключ.
+    """
+    
+    def __init__(self, capacity, error_rate=0.001):
+        """
+        Args:
+            capacity: Ожидаемое количество ключей
+            error_rate: Допустимая доля ложноположительных ответов
+        """
+        capacity = max(int(capacity), 1)
+        self.size = max(int(-capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+        self.hash_count = max(round(self.size / capacity * math.log(2)), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+    
+    def _positions(self, key_value):
+        digest = hashlib.blake2b(key_value.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        size = self.size
+        return [(h1 + i * h2) % size for i in range(self.hash_count)]
+    
+    def add(self, key_value):
+        """Добавление ключа в фильтр"""
+        bits = self.bits
+        for position in self._positions(key_value):
+            bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+    
+    def update(self, key_values):
+        """Добавление нескольких ключей"""
+        for key_value in key_values:
+            self.add(key_value)
+    
+    def __contains__(self, key_value):
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key_value))
+    
+    def __len__(self):
+        return self.count
+
+
+class KeyPermutation:
+    """
+    Ключевая перестановка чисел 0 .. size-1
+    
+    Сбалансированная сеть Фейстеля на 2*half битах с раундовой функцией
+    HMAC-SHA256; значения вне диапазона прогоняются повторно (cycle
+    walking), поэтому результат всегда меньше size. Перестановка обратима
+    (invert), разные входы дают разные выходы.
+    """
+    
+    def __init__(self, size, secret, rounds=8):
+        """
+        Args:
+            size: Размер области (например, число возможных ключей шаблона)
+            secret: Секрет перестановки (str или bytes)
+            rounds: Количество раундов сети
+        """
+        if size < 2:
+            raise ValueError("Размер области перестановки должен быть не меньше 2")
+        self.size = size
+        self.secret = secret.encode('utf-8') if isinstance(secret, str) else secret
+        self.rounds = rounds
+        self.half = ((size - 1).bit_length() + 1) // 2
+        self.mask = (1 << self.half) - 1
+        self._width = (self.half + 7) // 8
+    
+    def _round(self, i, value):
+        digest = hmac.new(
+            self.secret, bytes((i,)) + value.to_bytes(self._width, 'big'), hashlib.sha256
+        ).digest()
+        return int.from_bytes(digest, 'big') & self.mask
+    
+    def _encrypt(self, value):
+        left, right = value >> self.half, value & self.mask
+        for i in range(self.rounds):
+            left, right = right, left ^ self._round(i, right)
+        return (left << self.half) | right
+    
+    def _decrypt(self, value):
+        left, right = value >> self.half, value & self.mask
+        for i in reversed(range(self.rounds)):
+            left, right = right ^ self._round(i, left), left
+        return (left << self.half) | right
+    
+    def permute(self, index):
+        """Образ числа index"""
+        if not 0 <= index < self.size:
+            raise ValueError(f"Номер вне диапазона 0..{self.size - 1}: {index}")
+        value = self._encrypt(index)
+        while value >= self.size:
+            value = self._encrypt(value)
+        return value
+    
+    def invert(self, value):
+        """Прообраз числа value"""
+        if not 0 <= value < self.size:
+            raise ValueError(f"Значение вне диапазона 0..{self.size - 1}: {value}")
+        index = self._decrypt(value)
+        while index >= self.size:
+            index = self._decrypt(index)
+        return index
+
+
+class KeyPattern:
+    """
+    Скомпилированный шаблон ключа для проверки формата
+    
+    Шаблон один раз переводится в регулярное выражение, так что проверка
+    ключа - один fullmatch на C без цикла по символам. Причина отказа
+    вычисляется только для неподходящих ключей.
+    """
+    
+    def __init__(self, format_pattern, charsets):
+        """
+        Args:
+            format_pattern: Шаблон ключа
+            charsets: Словарь {символ шаблона: алфавит}, остальные символы
+                шаблона должны совпадать буквально
+        """
+        self.format_pattern = format_pattern
+        self.charsets = {slot: frozenset(charset) for slot, charset in charsets.items()}
+        
+        parts = []
+        for char, run in _runs(format_pattern):
+            if char in charsets:
+                part = '[' + ''.join(re.escape(c) for c in sorted(set(charsets[char]))) + ']'
+            else:
+                part = re.escape(char)
+            parts.append(part if run == 1 else f'(?:{part}){{{run}}}')
+        self.regex = re.compile(''.join(parts))
+    
+    def match(self, key):
+        """
+        Проверка ключа
+        
+        Returns:
+            bool: True если ключ соответствует шаблону
+        """
+        return isinstance(key, str) and self.regex.fullmatch(key) is not None
+    
+    def check(self, key):
+        """
+        Проверка ключа с причиной отказа
+        
+        Returns:
+            str | None: None если ключ подходит, иначе описание ошибки
+        """
+        if not isinstance(key, str):
+            return "ключ не является строкой"
+        if self.regex.fullmatch(key) is not None:
+            return None
+        if len(key) != len(self.format_pattern):
+            return f"длина {len(key)}, ожидалась {len(self.format_pattern)}"
+        for i, (char, expected) in enumerate(zip(key, self.format_pattern)):
+            allowed = self.charsets.get(expected)
+            if allowed is None:
+                if char != expected:
+                    return f"позиция {i + 1}: {char!r} вместо {expected!r}"
+            elif char not in allowed:
+                return f"позиция {i + 1}: недопустимый символ {char!r}"
+        return "ключ не соответствует шаблону"
+
+
+def _runs(text):
+    """Серии одинаковых символов: 'XXX-X' -> ('X', 3), ('-', 1), ('X', 1)"""
+    runs = []
+    for char in text:
+        if runs and runs[-1][0] == char:
+            runs[-1][1] += 1
+        else:
+            runs.append([char, 1])
+    return [(char, run) for char, run in runs]
+
+
+# Схемы контрольных символов (символ C в шаблоне)
+CHECK_MOD = 'mod'    # Luhn mod N: ловит опечатки и перестановки соседних символов
+CHECK_HMAC = 'hmac'  # Усечённый HMAC-SHA256 с секретом сервера: ловит и подделки
+CHECK_SCHEMES = (CHECK_MOD, CHECK_HMAC)
+
+
 class KeyGenerator:
     """Генератор уникальных ключей"""
     
-    def __init__(self, format_pattern='XXXX-XXXX-XXXX-XXXX'):
+    def __init__(self, format_pattern='XXXX-XXXX-XXXX-XXXX', charsets=None, check=None, secret=None,
+                 derive_secret=None):
         """
         Инициализация генератора
         
         Args:
             format_pattern: Шаблон ключа, где X заменяется на случайный символ
+            charsets: Необязательные алфавиты по символам шаблона, например
+                {'X': string.ascii_uppercase, '9': string.digits} для 'XXX-999'
+            check: Схема контрольных символов (CHECK_MOD или CHECK_HMAC),
+                символы C в шаблоне вычисляются по остальным случайным символам
+            secret: Секрет сервера для CHECK_HMAC
+            derive_secret: Секрет для вывода ключей по номеру (derive/key_index)
         """
         self.format_pattern = format_pattern
         self.charset = string.ascii_uppercase + string.digits  # A-Z, 0-9
+        self.charsets = dict(charsets) if charsets else {'X': self.charset}
+        if 'X' in self.charsets:
+            self.charset = self.charsets['X']
+        
+        self.check = check
+        self.check_positions = []
+        if check is not None:
+            self._init_check(check, secret)
+        
+        # Контрольные символы генерируются как литерал C и заменяются в _sign
+        random_charsets = {slot: chars for slot, chars in self.charsets.items() if slot != 'C' or not check}
+        self.payload_positions = [i for i, char in enumerate(format_pattern) if char in random_charsets]
+        self.engine = BatchKeyEngine(format_pattern, self.charset, charsets=random_charsets)
+        self.pattern = KeyPattern(format_pattern, self.charsets)
+        
+        # Пространство ключей как смешанная система счисления по случайным позициям
+        self.payload_charsets = [self.charsets[format_pattern[i]] for i in self.payload_positions]
+        self.payload_index = [{char: d for d, char in enumerate(chars)} for chars in self.payload_charsets]
+        self.key_space = 1
+        for chars in self.payload_charsets:
+            self.key_space *= len(chars)
+        self.permutation = KeyPermutation(self.key_space, derive_secret) if derive_secret else None
+    
+    def _init_check(self, check, secret):
+        if check not in CHECK_SCHEMES:
+            raise ValueError(f"Неизвестная схема контрольных символов: {check}")
+        self.check_positions = [i for i, char in enumerate(self.format_pattern) if char == 'C']
+        if not self.check_positions:
+            raise ValueError("В шаблоне нет позиций C для контрольных символов")
+        self.check_charset = self.charsets.setdefault('C', self.charset)
+        self.check_index = {char: i for i, char in enumerate(self.check_charset)}
+        
+        if check == CHECK_MOD:
+            if len(self.check_positions) != 1:
+                raise ValueError("Схема mod поддерживает один контрольный символ")
+            payload_chars = set().union(*(
+                chars for slot, chars in self.charsets.items() if slot != 'C' and slot in self.format_pattern
+            ))
+            if not payload_chars <= set(self.check_charset):
+                raise ValueError("Для схемы mod алфавит ключа должен входить в алфавит C")
+        else:
+            if not secret:
+                raise ValueError("Для схемы hmac нужен секрет")
+            self.secret = secret.encode('utf-8') if isinstance(secret, str) else secret
+    
+    def check_chars(self, payload):
+        """
+        Контрольные символы для случайной части ключа
+        
+        Args:
+            payload: Случайные символы ключа подряд, без разделителей и C
+            
+        Returns:
+            str: Контрольные символы по числу позиций C
+        """
+        n = len(self.check_charset)
+        if self.check == CHECK_MOD:
+            # Luhn mod N
+            factor = 2
+            total = 0
+            for char in reversed(payload):
+                addend = factor * self.check_index[char]
+                total += addend // n + addend % n
+                factor = 3 - factor
+            return self.check_charset[-total % n]
+        
+        digest = hmac.new(self.secret, payload.encode('utf-8'), hashlib.sha256).digest()
+        value = int.from_bytes(digest[:16], 'big')
+        chars = []
+        for _ in self.check_positions:
+            value, digit = divmod(value, n)
+            chars.append(self.check_charset[digit])
+        return ''.join(chars)
+    
+    def _payload(self, key):
+        return ''.join([key[i] for i in self.payload_positions])
+    
+    def _sign(self, keys):
+        """Подстановка контрольных символов в сгенерированные ключи"""
+        signed = []
+        for key in keys:
+            chars = list(key)
+            for position, char in zip(self.check_positions, self.check_chars(self._payload(key))):
+                chars[position] = char
+            signed.append(''.join(chars))
+        return signed
+    
+    def verify_check(self, key):
+        """
+        Проверка контрольных символов ключа, формат уже должен быть проверен
+        
+        Returns:
+            bool: True если контрольные символы верны (или схема не задана)
+        """
+        if self.check is None:
+            return True
+        expected = self.check_chars(self._payload(key))
+        actual = ''.join([key[i] for i in self.check_positions])
+        return hmac.compare_digest(expected, actual)
     
     def generate(self):
         """
@@ -22,28 +434,75 @@ class KeyGenerator:
         Returns:
             str: Сгенерированный ключ
         """
-        key = ''
-        for char in self.format_pattern:
-            if char == 'X':
-                key += random.choice(self.charset)
-            else:
-                key += char
-        return key
+        keys = self.engine.generate(1)
+        return (self._sign(keys) if self.check else keys)[0]
     
-    def generate_batch(self, count):
+    def generate_batch(self, count, exclude=None):
         """
         Генерация пакета уникальных ключей
         
         Args:
             count: Количество ключей для генерации
+            exclude: Уже занятые ключи, например Database.key_filter();
+                пакет с ними не пересекается и вставляется без конфликтов
             
         Returns:
             list: Список уникальных ключей
         """
-        keys = set()
-        while len(keys) < count:
-            keys.add(self.generate())
-        return list(keys)
+        return self.engine.generate_unique(count, exclude, self._sign if self.check else None)
+    
+    def derive(self, index):
+        """
+        Ключ с номером index
+        
+        Номер проходит через ключевую перестановку KeyPermutation, так что
+        разные номера всегда дают разные ключи, а по ключу без секрета
+        нельзя угадать соседние. Ключи не нужно генерировать заранее.
+        
+        Args:
+            index: Номер ключа, 0 <= index < key_space
+            
+        Returns:
+            str: Ключ
+        """
+        if self.permutation is None:
+            raise ValueError("Для вывода ключей нужен derive_secret")
+        value = self.permutation.permute(index)
+        chars = list(self.format_pattern)
+        for i in range(len(self.payload_positions) - 1, -1, -1):
+            value, digit = divmod(value, len(self.payload_charsets[i]))
+            chars[self.payload_positions[i]] = self.payload_charsets[i][digit]
+        key = ''.join(chars)
+        return self._sign([key])[0] if self.check else key
+    
+    def derive_batch(self, start, count):
+        """
+        Ключи с номерами start .. start + count - 1
+        
+        Returns:
+            list: Список ключей
+        """
+        return [self.derive(index) for index in range(start, start + count)]
+    
+    def key_index(self, key):
+        """
+        Номер ключа, выведенного через derive
+        
+        Обратная перестановка без обращения к базе. Сам по себе номер лишь
+        означает, что ключ лежит в пространстве шаблона; ключ наш, если номер
+        меньше счётчика выданных ключей (и контрольные символы верны).
+        
+        Returns:
+            int | None: Номер или None, если ключ не по формату
+        """
+        if self.permutation is None:
+            raise ValueError("Для вывода ключей нужен derive_secret")
+        if not self.validate_format(key):
+            return None
+        value = 0
+        for position, chars, index in zip(self.payload_positions, self.payload_charsets, self.payload_index):
+            value = value * len(chars) + index[key[position]]
+        return self.permutation.invert(value)
     
     def validate_format(self, key):
         """
@@ -52,21 +511,150 @@ class KeyGenerator:
         Args:
             key: Ключ для проверки
             
+        Контрольные символы (если схема задана) проверяются здесь же,
+        без обращения к базе.
+        
         Returns:
             bool: True если ключ соответствует формату
         """
-        if len(key) != len(self.format_pattern):
-            return False
+        return self.pattern.match(key) and self.verify_check(key)
+    
+    def validate_many(self, keys):
+        """
+        Потоковая проверка набора ключей
         
-        for i, char in enumerate(self.format_pattern):
-            if char == 'X':
-                if key[i] not in self.charset:
-                    return False
+        Args:
+            keys: Итерируемый набор ключей (можно генератор строк файла)
+            
+        Yields:
+            tuple: (key, reason), reason - None для подходящего ключа
+                или описание ошибки
+        """
+        fullmatch = self.pattern.regex.fullmatch
+        check = self.pattern.check
+        for key in keys:
+            if isinstance(key, str) and fullmatch(key) is not None:
+                if self.verify_check(key):
+                    yield key, None
+                else:
+                    yield key, "неверный контрольный символ"
             else:
-                if key[i] != char:
-                    return False
+                yield key, check(key)
+    
+    def codec(self):
+        """
+        Кодек для компактного хранения ключей этого генератора
+        
+        Returns:
+            KeyCodec: Кодек с тем же шаблоном и алфавитом
+        """
+        return KeyCodec(self.format_pattern, self.charset, charsets=self.charsets)
+
+
+class KeyCodec:
+    """
+    Компактное представление ключей по шаблону
+    
+    Ключ вида XXXX-XXXX-XXXX-XXXX - это число в системе счисления
+    len(charset), разделители из шаблона не хранятся. Для шаблона по
+    умолчанию получается 11 байт (~83 бита) вместо 19 символов текста.
+    """
+    
+    def __init__(self, format_pattern='XXXX-XXXX-XXXX-XXXX', charset=None, charsets=None):
+        """
+        Args:
+            format_pattern: Шаблон ключа, где X - символ из charset
+            charset: Алфавит ключа (по умолчанию A-Z, 0-9)
+            charsets: Алфавиты по символам шаблона (см. KeyGenerator)
+        """
+        self.format_pattern = format_pattern
+        self.charset = charset or string.ascii_uppercase + string.digits
+        self.charsets = charsets or {'X': self.charset}
+        # Для каждой случайной позиции: (позиция, алфавит, {символ: цифра})
+        self.positions = [
+            (i, self.charsets[char], {c: d for d, c in enumerate(self.charsets[char])})
+            for i, char in enumerate(format_pattern) if char in self.charsets
+        ]
+        capacity = 1
+        for _, position_charset, _ in self.positions:
+            capacity *= len(position_charset)
+        self.size = max(1, ((capacity - 1).bit_length() + 7) // 8)
+    
+    def encode(self, key):
+        """
+        Упаковка ключа
+        
+        Args:
+            key: Ключ в текстовом виде
+            
+        Returns:
+            bytes | None: Упакованный ключ или None, если ключ не по шаблону
+        """
+        if len(key) != len(self.format_pattern):
+            return None
+        value = 0
+        for i, char in enumerate(self.format_pattern):
+            if char not in self.charsets and key[i] != char:
+                return None
+        for i, position_charset, char_index in self.positions:
+            digit = char_index.get(key[i])
+            if digit is None:
+                return None
+            value = value * len(position_charset) + digit
+        return value.to_bytes(self.size, 'big')
+    
+    def decode(self, blob):
+        """
+        Распаковка ключа
         
-        return True
+        Args:
+            blob: Упакованный ключ
+            
+        Returns:
+            str: Ключ в текстовом виде
+        """
+        value = int.from_bytes(blob, 'big')
+        chars = list(self.format_pattern)
+        for i, position_charset, _ in reversed(self.positions):
+            value, digit = divmod(value, len(position_charset))
+            chars[i] = position_charset[digit]
+        return ''.join(chars)
+    
+    def dumps(self):
+        """
+        Параметры кодека строкой (шаблон и алфавиты)
+        
+        Сохраняется в базе рядом с упакованными ключами: по ней видно,
+        что шаблон сменился, и ключи можно распаковать прежним кодеком.
+        """
+        return json.dumps(
+            {'format_pattern': self.format_pattern, 'charsets': self.charsets},
+            sort_keys=True, ensure_ascii=False
+        )
+    
+    @classmethod
+    def loads(cls, data):
+        """Кодек из строки dumps()"""
+        params = json.loads(data)
+        return cls(params['format_pattern'], charsets=params['charsets'])
+
+
+def key_generator_from_env():
+    """
+    Генератор ключей из переменных окружения
+    
+    KEY_FORMAT - шаблон ключа, KEY_CHECK - схема контрольных символов
+    (mod или hmac), KEY_CHECK_SECRET - секрет для hmac, KEY_DERIVE_SECRET -
+    секрет для вывода ключей по номеру.
+    """
+    check = os.getenv('KEY_CHECK') or None
+    default_pattern = 'XXXX-XXXX-XXXX-XXXC' if check else 'XXXX-XXXX-XXXX-XXXX'
+    return KeyGenerator(
+        os.getenv('KEY_FORMAT') or default_pattern,
+        check=check,
+        secret=os.getenv('KEY_CHECK_SECRET'),
+        derive_secret=os.getenv('KEY_DERIVE_SECRET') or None,
+    )
 
 
 # Альтернативный генератор с использованием UUID
@@ -92,8 +680,23 @@ class UUIDKeyGenerator:
         Returns:
             str: Короткий ключ
         """
-        import uuid
-        return str(uuid.uuid4()).replace('-', '').upper()[:16]
+        return secrets.token_hex(8).upper()
+    
+    @staticmethod
+    def generate_short_batch(count):
+        """
+        Генерация пакета уникальных коротких ключей
+        
+        Args:
+            count: Количество ключей
+            
+        Returns:
+            list: Список ключей в формате generate_short
+        """
+        return _SHORT_ENGINE.generate_unique(count)
+
+
+_SHORT_ENGINE = BatchKeyEngine('X' * 16, '0123456789ABCDEF')
 
 
 # Генератор читаемых ключей (без похожих символов)
@@ -103,6 +706,7 @@ class ReadableKeyGenerator:
     def __init__(self):
         # Исключаем похожие символы: 0/O, 1/I/L, 2/Z, 5/S, 8/B
         self.charset = 'ACDEFGHJKLMNPQRTUVWXY34679'
+        self._engines = {}
     
     def generate(self, length=16, separator='-', group_size=4):
         """
@@ -116,11 +720,33 @@ class ReadableKeyGenerator:
         Returns:
             str: Сгенерированный ключ
         """
-        key = ''.join(random.choice(self.charset) for _ in range(length))
-        
-        # Группировка с разделителем
-        if separator and group_size > 0:
-            groups = [key[i:i+group_size] for i in range(0, len(key), group_size)]
-            key = separator.join(groups)
+        return self._engine(length, separator, group_size).generate(1)[0]
+    
+    def generate_batch(self, count, length=16, separator='-', group_size=4, exclude=None):
+        """
+        Генерация пакета уникальных читаемых ключей
         
-        return key
\ No newline at end of file
+        Args:
+            count: Количество ключей
+            length: Общая длина ключа (без разделителей)
+            separator: Разделитель групп
+            group_size: Размер группы символов
+            exclude: Уже занятые ключи
+            
+        Returns:
+            list: Список уникальных ключей
+        """
+        return self._engine(length, separator, group_size).generate_unique(count, exclude)
+    
+    def _engine(self, length, separator, group_size):
+        params = (length, separator, group_size)
+        engine = self._engines.get(params)
+        if engine is None:
+            # \0 в роли заполнителя, чтобы разделитель мог быть любым символом
+            pattern = '\0' * length
+            if separator and group_size > 0:
+                groups = [pattern[i:i+group_size] for i in range(0, length, group_size)]
+                pattern = separator.join(groups)
+            engine = BatchKeyEngine(pattern, self.charset, placeholder='\0')
+            self._engines[params] = engine
+        return engine
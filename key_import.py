@@ -0,0 +1,214 @@
+import argparse
+import csv
+import itertools
+import logging
+import os
+from collections import Counter
+
+from key_generator import KeyBloomFilter, KeyGenerator, key_generator_from_env
+from sharded_database import create_database
+
+logger = logging.getLogger(__name__)
+
+REASON_DUPLICATE_IN_FILE = "повтор в файле"
+REASON_EXISTS = "уже есть в базе"
+
+
+def read_keys(path, column=0):
+    """
+    Потоковое чтение ключей из файла
+
+    Текстовый файл - по ключу в строке, CSV (*.csv) - ключ в колонке column.
+    Пустые строки пропускаются, пробелы по краям отбрасываются.
+
+    Yields:
+        tuple: (номер строки, ключ)
+    """
+    with open(path, encoding='utf-8-sig', errors='replace', newline='') as f:
+        if path.lower().endswith('.csv'):
+            for line_no, row in enumerate(csv.reader(f), 1):
+                if len(row) > column and row[column].strip():
+                    yield line_no, row[column].strip()
+        else:
+            for line_no, line in enumerate(f, 1):
+                key = line.strip()
+                if key:
+                    yield line_no, key
+
+
+def validator_for(pattern, default=None):
+    """
+    Генератор для проверки формата при импорте
+
+    Args:
+        pattern: Шаблон ключей импорта, 'any' - без проверки формата,
+            None - формат по умолчанию (default)
+        default: KeyGenerator бота
+
+    Returns:
+        KeyGenerator | None
+    """
+    if pattern == 'any':
+        return None
+    if pattern:
+        return KeyGenerator(pattern)
+    return default
+
+
+class _RejectWriter:
+    """CSV-отчёт об отклонённых строках, файл создаётся при первой записи"""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._writer = None
+
+    def write(self, line_no, key, reason):
+        if self.path is None:
+            return
+        if self._writer is None:
+            self._file = open(self.path, 'w', encoding='utf-8', newline='')
+            self._writer = csv.writer(self._file)
+            self._writer.writerow(['line', 'key', 'reason'])
+        self._writer.writerow([line_no, key, reason])
+
+    @property
+    def written(self):
+        return self._file is not None
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+
+def import_keys(db, path, validator=None, rejects_path=None, chunk_size=5000, progress=None):
+    """
+    Импорт ключей из файла поставщика
+
+    Файл читается построчно, ключи проверяются на формат и дубликаты
+    (внутри пачки - по словарю, с базой - фильтром Блума с точной
+    проверкой положительных ответов; занятый ключ, который вставил этот
+    же импорт, считается повтором в файле) и вставляются пачками по chunk_size,
+    каждая в своей транзакции. В памяти держится только текущая пачка
+    и фильтр.
+
+    Args:
+        db: Database или ShardedDatabase
+        path: Файл с ключами (*.txt или *.csv)
+        validator: KeyGenerator для проверки формата (None - без проверки)
+        rejects_path: Куда писать CSV с отклонёнными строками (None - не писать)
+        chunk_size: Размер пачки вставки
+        progress: Необязательный callback(processed, inserted, rejected) после каждой пачки
+
+    Returns:
+        dict: {'processed', 'inserted', 'rejected', 'reasons': {причина: количество},
+               'rejects_path': str | None}
+    """
+    # Оценка числа строк для размера фильтра: ключ с переводом строки - от 16 байт
+    estimate = os.path.getsize(path) // 16
+    existing = db.key_filter(extra=estimate)
+    # Ключи, вставленные этим импортом: повтор из прошлой пачки - повтор в файле
+    imported = KeyBloomFilter(max(estimate, chunk_size), error_rate=0.0001)
+    reasons = Counter()
+    rejects = _RejectWriter(rejects_path)
+    processed = 0
+    inserted = 0
+
+    def reject(line_no, key, reason):
+        reasons[reason] += 1
+        rejects.write(line_no, key, reason)
+
+    def flush(chunk):
+        nonlocal inserted
+        # Фильтр без ложноотрицательных ответов: точно проверяем только
+        # ключи, которые он считает занятыми
+        suspects = [key for key in chunk if key in existing]
+        taken = db.existing_keys(suspects) if suspects else set()
+        fresh = []
+        for key, line_no in chunk.items():
+            if key in taken:
+                reject(line_no, key, REASON_DUPLICATE_IN_FILE if key in imported else REASON_EXISTS)
+            else:
+                fresh.append(key)
+        if fresh:
+            added = db.insert_keys(fresh)
+            existing.update(fresh)
+            imported.update(fresh)
+            inserted += added
+            # Ключ, добавленный параллельно между проверкой и вставкой
+            if len(fresh) > added:
+                reasons[REASON_EXISTS] += len(fresh) - added
+        if progress is not None:
+            progress(processed, inserted, sum(reasons.values()))
+
+    try:
+        keys = read_keys(path)
+        if validator is not None:
+            # Ключи идут в validate_many и обратно в том же порядке,
+            # tee держит в буфере одну строку
+            numbered, plain = itertools.tee(keys)
+            checked = (
+                (line_no, key, reason)
+                for (line_no, key), (_, reason) in zip(
+                    numbered, validator.validate_many(key for _, key in plain)
+                )
+            )
+        else:
+            checked = ((line_no, key, None) for line_no, key in keys)
+
+        chunk = {}
+        for line_no, key, reason in checked:
+            processed += 1
+            if reason is not None:
+                reject(line_no, key, reason)
+            elif key in chunk:
+                reject(line_no, key, REASON_DUPLICATE_IN_FILE)
+            else:
+                chunk[key] = line_no
+                if len(chunk) >= chunk_size:
+                    flush(chunk)
+                    chunk = {}
+        if chunk:
+            flush(chunk)
+    finally:
+        rejects.close()
+
+    rejected = sum(reasons.values())
+    db.log_action(None, 'keys_imported', f'Inserted: {inserted}, Rejected: {rejected}')
+    logger.info(f"Импорт {path}: добавлено {inserted}, отклонено {rejected}")
+    return {
+        'processed': processed,
+        'inserted': inserted,
+        'rejected': rejected,
+        'reasons': dict(reasons),
+        'rejects_path': rejects.path if rejects.written else None,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Импорт ключей поставщика из файла')
+    parser.add_argument('file', help='Файл с ключами (*.txt - по ключу в строке, *.csv - первая колонка)')
+    parser.add_argument('--db', help='Путь к базе данных')
+    parser.add_argument('--pattern', help="Шаблон ключей (по умолчанию KEY_FORMAT, 'any' - без проверки)")
+    parser.add_argument('--rejects', default='rejects.csv', help='Файл отчёта об отклонённых строках')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+
+    key_gen = key_generator_from_env()
+    key_codec = key_gen.codec() if os.getenv('KEY_STORAGE') == 'compact' else None
+    db = create_database(args.db, buffered_logs=False, key_codec=key_codec)
+    try:
+        db.init_db()
+        result = import_keys(
+            db, args.file,
+            validator=validator_for(args.pattern, key_gen),
+            rejects_path=args.rejects,
+        )
+    finally:
+        db.close()
+    print(result)
+
+
+if __name__ == '__main__':
+    main()
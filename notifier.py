@@ -0,0 +1,149 @@
+import asyncio
+import logging
+
+from aiogram.exceptions import TelegramNetworkError, TelegramServerError
+from aiogram.types import InlineKeyboardMarkup
+
+from outbound import outbound_priority, PRIORITY_NOTIFICATION
+
+logger = logging.getLogger(__name__)
+
+# Ограничения Telegram на одно сообщение с запасом
+DIGEST_MAX_CHARS = 3500
+DIGEST_MAX_BUTTONS = 80
+
+
+class AdminNotifier:
+    """
+    Фоновая рассылка уведомлений администраторам
+
+    notify() только кладёт уведомление в очередь каждого админа и сразу
+    возвращается. У каждого админа своя задача-отправитель, поэтому
+    рассылка идёт параллельно, а медленный или заблокировавший бота админ
+    не задерживает остальных. Сетевые и серверные ошибки повторяются с
+    экспоненциальной паузой; RetryAfter ждёт и повторяет общая очередь
+    исходящих сообщений (outbound.py). Если очередь админа выросла до
+    digest_threshold, накопившиеся уведомления уходят одной сводкой.
+    """
+
+    def __init__(self, bot, admin_ids, max_retries=5, base_delay=1.0, digest_threshold=3):
+        """
+        Args:
+            bot: Bot
+            admin_ids: ID администраторов
+            max_retries: Повторов при сетевой или серверной ошибке
+            base_delay: Первая пауза перед повтором при сетевой ошибке, сек
+            digest_threshold: С какой длины очереди уведомления сводятся в одно
+        """
+        self.bot = bot
+        self.admin_ids = list(admin_ids)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.digest_threshold = digest_threshold
+        self._queues = {}
+        self._workers = {}
+
+    def notify(self, text, reply_markup=None, digest_markup=None):
+        """
+        Уведомление всем администраторам
+
+        Args:
+            text: Текст уведомления
+            reply_markup: Клавиатура одиночного сообщения
+            digest_markup: Клавиатура уведомления в составе сводки
+                (по умолчанию reply_markup)
+        """
+        item = (text, reply_markup, digest_markup or reply_markup)
+        for admin_id in self.admin_ids:
+            self._queue(admin_id).put_nowait(item)
+
+    def _queue(self, admin_id):
+        queue = self._queues.get(admin_id)
+        if queue is None:
+            queue = self._queues[admin_id] = asyncio.Queue()
+            self._workers[admin_id] = asyncio.create_task(self._worker(admin_id, queue))
+        return queue
+
+    @property
+    def queue_depth(self):
+        """Сколько уведомлений ждёт отправки по всем админам"""
+        return sum(queue.qsize() for queue in self._queues.values())
+
+    async def _worker(self, admin_id, queue):
+        # Уведомления уступают в общей очереди выдаче ключей и ответам пользователям
+        outbound_priority.set(PRIORITY_NOTIFICATION)
+        carry = None
+        while True:
+            item = carry or await queue.get()
+            carry = None
+            batch = [item]
+            if queue.qsize() + 1 >= self.digest_threshold:
+                carry = self._fill_digest(queue, batch)
+            try:
+                if len(batch) == 1:
+                    text, reply_markup, _ = item
+                    await self._send(admin_id, text, reply_markup)
+                else:
+                    await self._send(admin_id, *self._digest(batch))
+            except Exception as e:
+                logger.error(f"Уведомление админу {admin_id} не доставлено: {e}")
+            finally:
+                for _ in batch:
+                    queue.task_done()
+
+    @staticmethod
+    def _fill_digest(queue, batch):
+        """
+        Добрать из очереди уведомления, которые поместятся в одну сводку
+
+        Returns:
+            tuple | None: Уведомление, которое не поместилось (уйдёт следующим)
+        """
+        chars = sum(len(text) for text, _, _ in batch)
+        buttons = sum(_button_count(markup) for _, _, markup in batch)
+        while not queue.empty():
+            item = queue.get_nowait()
+            text, _, markup = item
+            if chars + len(text) > DIGEST_MAX_CHARS or buttons + _button_count(markup) > DIGEST_MAX_BUTTONS:
+                return item
+            batch.append(item)
+            chars += len(text)
+            buttons += _button_count(markup)
+        return None
+
+    @staticmethod
+    def _digest(batch):
+        text = f"📬 Уведомлений: {len(batch)}\n\n" + "\n\n➖➖➖\n\n".join(item[0] for item in batch)
+        rows = [row for _, _, markup in batch if markup for row in markup.inline_keyboard]
+        return text, InlineKeyboardMarkup(inline_keyboard=rows) if rows else None
+
+    async def _send(self, admin_id, text, reply_markup):
+        delay = self.base_delay
+        for attempt in range(self.max_retries + 1):
+            try:
+                return await self.bot.send_message(admin_id, text, reply_markup=reply_markup)
+            except (TelegramNetworkError, TelegramServerError) as e:
+                if attempt == self.max_retries:
+                    raise
+                logger.warning(f"Ошибка отправки админу {admin_id}: {e}, повтор через {delay} с")
+                await asyncio.sleep(delay)
+                delay *= 2
+
+    async def close(self, timeout=10):
+        """Дождаться отправки очереди (не дольше timeout) и остановить задачи"""
+        if self._queues:
+            try:
+                await asyncio.wait_for(
+                    asyncio.gather(*(queue.join() for queue in self._queues.values())),
+                    timeout
+                )
+            except asyncio.TimeoutError:
+                logger.warning(f"Не отправлено уведомлений админам: {self.queue_depth}")
+        for worker in self._workers.values():
+            worker.cancel()
+
+
+def _button_count(markup):
+    if markup is None:
+        return 0
+    return sum(len(row) for row in markup.inline_keyboard)
@@ -0,0 +1,406 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты исходящих запросов: меньше - важнее
+PRIORITY_KEY = 0           # Выдача купленного ключа
+PRIORITY_INTERACTIVE = 1   # Ответы на действия пользователя (по умолчанию)
+PRIORITY_NOTIFICATION = 2  # Уведомления, прогресс фоновых задач
+PRIORITY_NAMES = {
+    PRIORITY_KEY: 'key',
+    PRIORITY_INTERACTIVE: 'interactive',
+    PRIORITY_NOTIFICATION: 'notification',
+}
+
+# Приоритет запросов, отправляемых из текущего контекста (задачи или потока)
+outbound_priority = contextvars.ContextVar('outbound_priority', default=PRIORITY_INTERACTIVE)
+
+
+@contextmanager
+def send_priority(priority):
+    """Отправка запросов внутри блока с заданным приоритетом"""
+    token = outbound_priority.set(priority)
+    try:
+        yield
+    finally:
+        outbound_priority.reset(token)
+
+
+class TokenBucket:
+    """
+    Ведро токенов: rate запросов в секунду, всплеск до capacity
+
+    Время передаётся явно, чтобы одно ведро работало и с часами event loop,
+    и с time.monotonic().
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = None
+        self.paused_until = 0.0
+
+    def _refill(self, now):
+        if self.updated is not None:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        """Через сколько секунд будет доступен токен"""
+        self._refill(now)
+        wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self.paused_until - now)
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def pause(self, until):
+        """Не выдавать токены до момента until (ответ 429 от Telegram)"""
+        self.paused_until = max(self.paused_until, until)
+
+    def idle(self, now):
+        """Ведро полное и не на паузе - его можно забыть"""
+        self._refill(now)
+        return self.tokens >= self.capacity and self.paused_until <= now
+
+
+class _Job:
+    __slots__ = ('call', 'chat_id', 'priority', 'enqueued_at', 'attempts', 'future')
+
+    def __init__(self, call, chat_id, priority, enqueued_at):
+        self.call = call
+        self.chat_id = chat_id
+        self.priority = priority
+        self.enqueued_at = enqueued_at
+        self.attempts = 0
+        self.future = None
+
+
+class OutboundQueue:
+    """
+    Очередь исходящих запросов с приоритетами и лимитами
+
+    Запросы выдаются по приоритету, внутри приоритета - по порядку
+    поступления. Общий лимит - глобальное ведро токенов, у каждого чата
+    своё ведро. Запросы чата, исчерпавшего лимит, откладываются до его
+    восстановления и не задерживают остальные чаты. Не потокобезопасна,
+    синхронизация - на стороне планировщика.
+    """
+
+    def __init__(self, global_rate=30, chat_rate=1, chat_burst=3, max_chat_buckets=10000):
+        """
+        Args:
+            global_rate: Запросов в секунду на всего бота
+            chat_rate: Запросов в секунду в один чат
+            chat_burst: Сколько запросов в чат можно отправить подряд
+            max_chat_buckets: После скольких вёдер чатов чистить простаивающие
+        """
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_chat_buckets = max_chat_buckets
+        self._chat_buckets = {}
+        self._ready = []   # (priority, seq, job)
+        self._parked = {}  # chat_id -> [(priority, seq, job)]
+        self._timers = []  # (ready_at, chat_id)
+        self._seq = itertools.count()
+
+    def __len__(self):
+        return len(self._ready) + sum(len(entries) for entries in self._parked.values())
+
+    def depth_by_priority(self):
+        depth = dict.fromkeys(PRIORITY_NAMES.values(), 0)
+        entries = itertools.chain(self._ready, *self._parked.values())
+        for priority, _, _ in entries:
+            name = PRIORITY_NAMES.get(priority, str(priority))
+            depth[name] = depth.get(name, 0) + 1
+        return depth
+
+    def push(self, job):
+        heapq.heappush(self._ready, (job.priority, next(self._seq), job))
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def penalize(self, chat_id, until):
+        """Пауза чата (или всего бота при chat_id=None) после 429"""
+        if chat_id is None:
+            self.global_bucket.pause(until)
+        else:
+            self._chat_bucket(chat_id).pause(until)
+
+    def _park(self, entry, chat_id, ready_at):
+        if chat_id not in self._parked:
+            self._parked[chat_id] = []
+            heapq.heappush(self._timers, (ready_at, chat_id))
+        self._parked[chat_id].append(entry)
+
+    def _release(self, now):
+        while self._timers and self._timers[0][0] <= now:
+            _, chat_id = heapq.heappop(self._timers)
+            for entry in self._parked.pop(chat_id, ()):
+                heapq.heappush(self._ready, entry)
+
+    def _prune(self, now):
+        if len(self._chat_buckets) <= self.max_chat_buckets:
+            return
+        for chat_id in [chat_id for chat_id, bucket in self._chat_buckets.items()
+                        if chat_id not in self._parked and bucket.idle(now)]:
+            del self._chat_buckets[chat_id]
+
+    def pop_ready(self, now):
+        """
+        Следующий запрос, который можно отправить сейчас
+
+        Returns:
+            tuple: (job, None) или (None, wait) - через сколько секунд
+                стоит проверить снова (None - очередь пуста)
+        """
+        self._release(now)
+        while self._ready:
+            entry = self._ready[0]
+            job = entry[2]
+            bucket = None
+            if job.chat_id is not None:
+                if job.chat_id in self._parked:
+                    heapq.heappop(self._ready)
+                    self._parked[job.chat_id].append(entry)
+                    continue
+                bucket = self._chat_bucket(job.chat_id)
+                wait = bucket.wait_time(now)
+                if wait > 0:
+                    heapq.heappop(self._ready)
+                    self._park(entry, job.chat_id, now + wait)
+                    continue
+            wait = self.global_bucket.wait_time(now)
+            if wait > 0:
+                return None, wait
+            heapq.heappop(self._ready)
+            self.global_bucket.take(now)
+            if bucket is not None:
+                bucket.take(now)
+            self._prune(now)
+            return job, None
+        if self._timers:
+            return None, max(self._timers[0][0] - now, 0.0)
+        return None, None
+
+
+class _SchedulerBase:
+    """Общее для планировщиков: очередь, повторы и метрики"""
+
+    def __init__(self, global_rate=30, chat_rate=1, chat_burst=3, max_retries=3, retry_after=None):
+        """
+        Args:
+            global_rate: Запросов в секунду на всего бота
+            chat_rate: Запросов в секунду в один чат
+            chat_burst: Сколько запросов в чат можно отправить подряд
+            max_retries: Повторов одного запроса после 429
+            retry_after: Функция(исключение) -> секунды ожидания, если это
+                ошибка flood control, иначе None
+        """
+        self.queue = OutboundQueue(global_rate, chat_rate, chat_burst)
+        self.max_retries = max_retries
+        self.retry_after = retry_after
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self._latencies = deque(maxlen=1000)
+
+    def _make_job(self, call, chat_id, priority, now):
+        if priority is None:
+            priority = outbound_priority.get()
+        return _Job(call, chat_id, priority, now)
+
+    def _started(self, job, now):
+        if job.attempts == 0:
+            self._latencies.append(now - job.enqueued_at)
+
+    def _retry_delay(self, job, error):
+        """Пауза перед повтором или None, если повторять не нужно"""
+        if self.retry_after is None or job.attempts >= self.max_retries:
+            return None
+        delay = self.retry_after(error)
+        if delay is None:
+            return None
+        job.attempts += 1
+        self.retried += 1
+        logger.warning(f"Flood control для чата {job.chat_id}, повтор через {delay} с")
+        return delay
+
+    def stats(self):
+        """
+        Метрики очереди
+
+        Returns:
+            dict: глубина очереди (всего и по приоритетам), счётчики и
+                задержка в очереди (среднее, p95, максимум за последние
+                1000 запросов), сек
+        """
+        latencies = sorted(self._latencies)
+        return {
+            'depth': len(self.queue),
+            'depth_by_priority': self.queue.depth_by_priority(),
+            'sent': self.sent,
+            'retried': self.retried,
+            'failed': self.failed,
+            'latency_avg': sum(latencies) / len(latencies) if latencies else 0.0,
+            'latency_p95': latencies[int(len(latencies) * 0.95)] if latencies else 0.0,
+            'latency_max': latencies[-1] if latencies else 0.0,
+        }
+
+
+class OutboundScheduler(_SchedulerBase):
+    """
+    Планировщик исходящих запросов для asyncio
+
+    submit() ставит запрос в очередь и ждёт его результата. Запросы
+    отправляются по приоритету в пределах лимитов Telegram; при 429
+    чат ставится на паузу, а запрос возвращается в очередь.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._wakeup = asyncio.Event()
+        self._runner = None
+        self._tasks = set()
+
+    async def submit(self, call, chat_id=None, priority=None):
+        """
+        Отправка запроса через очередь
+
+        Args:
+            call: Корутинная функция без аргументов, выполняющая запрос
+            chat_id: Чат-получатель (None - только общий лимит)
+            priority: Приоритет (по умолчанию из outbound_priority)
+
+        Returns:
+            Результат call()
+        """
+        loop = asyncio.get_running_loop()
+        job = self._make_job(call, chat_id, priority, loop.time())
+        job.future = loop.create_future()
+        self.queue.push(job)
+        self._wakeup.set()
+        if self._runner is None or self._runner.done():
+            self._runner = asyncio.create_task(self._run())
+        return await job.future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            job, wait = self.queue.pop_ready(loop.time())
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            if job.future.done():
+                # Ожидавший результата уже отменён
+                continue
+            task = asyncio.create_task(self._execute(job))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _execute(self, job):
+        loop = asyncio.get_running_loop()
+        self._started(job, loop.time())
+        try:
+            result = await job.call()
+        except Exception as e:
+            delay = self._retry_delay(job, e)
+            if delay is not None:
+                self.queue.penalize(job.chat_id, loop.time() + delay)
+                self.queue.push(job)
+                self._wakeup.set()
+                return
+            self.failed += 1
+            if not job.future.done():
+                job.future.set_exception(e)
+        else:
+            self.sent += 1
+            if not job.future.done():
+                job.future.set_result(result)
+
+    async def close(self):
+        if self._runner is not None:
+            self._runner.cancel()
+
+
+class ThreadedOutboundScheduler(_SchedulerBase):
+    """
+    Планировщик исходящих запросов для синхронного кода (потоки)
+
+    Очередь разбирает фоновый поток, запросы выполняются в пуле из workers
+    потоков. submit() по умолчанию блокирует вызывающий поток до ответа.
+    """
+
+    def __init__(self, *args, workers=4, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._cond = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, call, chat_id=None, priority=None, wait=True):
+        """
+        Отправка запроса через очередь
+
+        Args:
+            call: Функция без аргументов, выполняющая запрос
+            chat_id: Чат-получатель (None - только общий лимит)
+            priority: Приоритет (по умолчанию из outbound_priority)
+            wait: Ждать результата; иначе вернуть Future
+
+        Returns:
+            Результат call() или Future
+        """
+        job = self._make_job(call, chat_id, priority, time.monotonic())
+        job.future = Future()
+        with self._cond:
+            self.queue.push(job)
+            self._cond.notify()
+        return job.future.result() if wait else job.future
+
+    def _run(self):
+        while True:
+            with self._cond:
+                job, wait = self.queue.pop_ready(time.monotonic())
+                if job is None:
+                    self._cond.wait(wait)
+                    continue
+            self._executor.submit(self._execute, job)
+
+    def _execute(self, job):
+        self._started(job, time.monotonic())
+        try:
+            result = job.call()
+        except Exception as e:
+            delay = self._retry_delay(job, e)
+            if delay is not None:
+                with self._cond:
+                    self.queue.penalize(job.chat_id, time.monotonic() + delay)
+                    self.queue.push(job)
+                    self._cond.notify()
+                return
+            self.failed += 1
+            job.future.set_exception(e)
+        else:
+            self.sent += 1
+            job.future.set_result(result)
@@ -0,0 +1,282 @@
+import argparse
+import gzip
+import json
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+
+from database import Database
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_LOGS_SQL = '''
+    CREATE TABLE IF NOT EXISTS archive.logs (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER,
+        action TEXT NOT NULL,
+        details TEXT,
+        created_at TIMESTAMP
+    )
+'''
+
+
+class LogRetention:
+    """
+    Ретеншн таблицы logs
+
+    Старые строки пачками переносятся в архив (отдельный файл SQLite или
+    сжатый JSONL), перед удалением по ним копятся дневные агрегаты в
+    logs_daily. После переноса освобождённые страницы возвращаются
+    через incremental vacuum, так что рабочая база остаётся маленькой.
+    """
+
+    def __init__(self, db, max_age_days=90, max_rows=None,
+                 archive_path='logs_archive.db', batch_size=5000, vacuum_pages=10000):
+        """
+        Args:
+            db: Объект Database
+            max_age_days: Хранить в рабочей базе логи не старше N дней (None - без ограничения)
+            max_rows: Хранить в рабочей базе не больше N последних строк (None - без ограничения)
+            archive_path: Файл архива: *.db - SQLite, *.jsonl.gz - сжатый JSONL, None - без архива
+            batch_size: Размер пачки переноса
+            vacuum_pages: Сколько свободных страниц возвращать за один запуск
+        """
+        self.db = db
+        self.max_age_days = max_age_days
+        self.max_rows = max_rows
+        self.archive_path = archive_path
+        self.batch_size = batch_size
+        self.vacuum_pages = vacuum_pages
+
+    @property
+    def archive_is_jsonl(self):
+        return bool(self.archive_path) and self.archive_path.endswith(('.jsonl', '.jsonl.gz'))
+
+    def get_cutoff_id(self):
+        """
+        Максимальный id строки, подлежащей переносу
+
+        Returns:
+            int: id или 0, если переносить нечего
+        """
+        conn = self.db.get_connection()
+        cutoff_id = 0
+
+        if self.max_age_days is not None:
+            cutoff_date = datetime.now(timezone.utc) - timedelta(days=self.max_age_days)
+            row = conn.execute(
+                'SELECT MAX(id) as id FROM logs WHERE created_at < ?',
+                (cutoff_date.strftime('%Y-%m-%d %H:%M:%S'),)
+            ).fetchone()
+            cutoff_id = max(cutoff_id, row['id'] or 0)
+
+        if self.max_rows is not None:
+            row = conn.execute(
+                'SELECT id FROM logs ORDER BY id DESC LIMIT 1 OFFSET ?',
+                (self.max_rows,)
+            ).fetchone()
+            if row:
+                cutoff_id = max(cutoff_id, row['id'])
+
+        return cutoff_id
+
+    def run(self):
+        """
+        Один проход ретеншна
+
+        Returns:
+            dict: {'archived': int, 'vacuumed_pages': int}
+        """
+        cutoff_id = self.get_cutoff_id()
+        archived = 0
+        if cutoff_id:
+            if self.archive_is_jsonl:
+                archived = self._move_to_jsonl(cutoff_id)
+            else:
+                archived = self._move_to_sqlite(cutoff_id)
+
+        vacuumed_pages = self.incremental_vacuum()
+
+        if archived:
+            logger.info(f"Ретеншн логов: перенесено {archived} строк, освобождено {vacuumed_pages} страниц")
+            self.db.log_action(None, 'logs_archived', f'Rows: {archived}, Cutoff ID: {cutoff_id}')
+        return {'archived': archived, 'vacuumed_pages': vacuumed_pages}
+
+    def _next_batch_upper(self, conn, cutoff_id):
+        row = conn.execute(
+            'SELECT MAX(id) as id FROM (SELECT id FROM logs WHERE id <= ? ORDER BY id LIMIT ?)',
+            (cutoff_id, self.batch_size)
+        ).fetchone()
+        return row['id']
+
+    def _rollup_and_delete(self, conn, upper):
+        conn.execute(
+            '''INSERT INTO logs_daily (day, action, count)
+               SELECT date(created_at), action, COUNT(*) FROM logs
+               WHERE id <= ?
+               GROUP BY date(created_at), action
+               ON CONFLICT (day, action) DO UPDATE SET count = count + excluded.count''',
+            (upper,)
+        )
+        return conn.execute('DELETE FROM logs WHERE id <= ?', (upper,)).rowcount
+
+    def _move_to_sqlite(self, cutoff_id):
+        conn = self.db.get_connection()
+        moved = 0
+        if self.archive_path:
+            conn.execute('ATTACH DATABASE ? AS archive', (self.archive_path,))
+        try:
+            if self.archive_path:
+                conn.execute(ARCHIVE_LOGS_SQL)
+            while True:
+                with conn:
+                    conn.execute('BEGIN IMMEDIATE')
+                    upper = self._next_batch_upper(conn, cutoff_id)
+                    if upper is None:
+                        break
+                    if self.archive_path:
+                        conn.execute(
+                            'INSERT OR IGNORE INTO archive.logs SELECT id, user_id, action, details, created_at '
+                            'FROM logs WHERE id <= ?',
+                            (upper,)
+                        )
+                    moved += self._rollup_and_delete(conn, upper)
+        finally:
+            if self.archive_path:
+                conn.execute('DETACH DATABASE archive')
+        return moved
+
+    def _move_to_jsonl(self, cutoff_id):
+        conn = self.db.get_connection()
+        opener = gzip.open if self.archive_path.endswith('.gz') else open
+        moved = 0
+        while True:
+            with conn:
+                conn.execute('BEGIN IMMEDIATE')
+                upper = self._next_batch_upper(conn, cutoff_id)
+                if upper is None:
+                    break
+                rows = conn.execute(
+                    'SELECT * FROM logs WHERE id <= ? ORDER BY id', (upper,)
+                ).fetchall()
+                # Сначала архив, потом удаление: при сбое строки
+                # могут задублироваться в архиве, но не потеряются
+                with opener(self.archive_path, 'at', encoding='utf-8') as f:
+                    for row in rows:
+                        f.write(json.dumps(dict(row), ensure_ascii=False, default=str))
+                        f.write('\n')
+                moved += self._rollup_and_delete(conn, upper)
+        return moved
+
+    def incremental_vacuum(self):
+        """
+        Возврат свободных страниц файлу базы
+
+        Работает только в режиме auto_vacuum=INCREMENTAL: новые базы
+        создаются в нём сразу, старые переводятся enable_incremental_vacuum.
+
+        Returns:
+            int: Количество освобождённых страниц
+        """
+        conn = self.db.get_connection()
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+            return 0
+        before = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        if not before:
+            return 0
+        # Через execute() sqlite3 делает только один шаг прагмы (одна страница)
+        conn.executescript(f'PRAGMA incremental_vacuum({int(self.vacuum_pages)});')
+        after = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        return before - after
+
+    def enable_incremental_vacuum(self):
+        """
+        Однократный перевод базы в auto_vacuum=INCREMENTAL
+
+        Требует полного VACUUM, который блокирует базу на время выполнения,
+        поэтому запускается вручную (retention.py --enable-incremental-vacuum).
+        """
+        conn = self.db.get_connection()
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+            return
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('VACUUM')
+        logger.info("База переведена в режим auto_vacuum=INCREMENTAL")
+
+
+def archive_path_for(archive_path, db_path):
+    """
+    Отдельный файл архива для одного из нескольких файлов базы
+
+    id логов в шардах пересекаются, поэтому общий архив терял бы строки:
+    logs_archive.db -> logs_archive.bot_database.shard0.db
+
+    Args:
+        archive_path: Общий путь архива из настроек
+        db_path: Путь к файлу базы
+
+    Returns:
+        str: Путь архива этого файла
+    """
+    stem = os.path.splitext(os.path.basename(db_path))[0]
+    for ext in ('.jsonl.gz', '.jsonl'):
+        if archive_path.endswith(ext):
+            return f'{archive_path[:-len(ext)]}.{stem}{ext}'
+    base, ext = os.path.splitext(archive_path)
+    return f'{base}.{stem}{ext}'
+
+
+def retention_from_env(db, per_database=False):
+    """
+    Настройки ретеншна из переменных окружения
+
+    Args:
+        db: Объект Database
+        per_database: Архив в отдельном файле по имени базы
+            (когда файлов базы несколько, см. archive_path_for)
+    """
+    max_age_days = os.getenv('LOG_RETENTION_DAYS', '90')
+    max_rows = os.getenv('LOG_RETENTION_MAX_ROWS')
+    archive_path = os.getenv('LOG_ARCHIVE_PATH', 'logs_archive.db') or None
+    if archive_path and per_database:
+        archive_path = archive_path_for(archive_path, db.db_path)
+    return LogRetention(
+        db,
+        max_age_days=int(max_age_days) if max_age_days else None,
+        max_rows=int(max_rows) if max_rows else None,
+        archive_path=archive_path,
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Ретеншн и архивация таблицы logs')
+    parser.add_argument('--db', default=os.getenv('DATABASE_PATH', 'bot_database.db'),
+                        help='Путь к базе данных')
+    parser.add_argument('--days', type=int, help='Хранить логи не старше N дней')
+    parser.add_argument('--max-rows', type=int, help='Хранить не больше N последних строк')
+    parser.add_argument('--archive', help='Файл архива (*.db или *.jsonl.gz)')
+    parser.add_argument('--enable-incremental-vacuum', action='store_true',
+                        help='Перевести базу в auto_vacuum=INCREMENTAL (полный VACUUM)')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+
+    db = Database(args.db)
+    try:
+        db.init_db()
+        retention = retention_from_env(db)
+        if args.days is not None:
+            retention.max_age_days = args.days
+        if args.max_rows is not None:
+            retention.max_rows = args.max_rows
+        if args.archive:
+            retention.archive_path = args.archive
+        if args.enable_incremental_vacuum:
+            retention.enable_incremental_vacuum()
+        print(retention.run())
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,362 @@
+import heapq
+import logging
+import os
+
+from database import (
+    Database, EXPORT_TABLES,
+    InvalidTransition, CLAIM_OK, CLAIM_OUT_OF_STOCK, CLAIM_ERROR,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class ShardedDatabase:
+    """
+    Хранилище, разнесённое по нескольким файлам SQLite
+
+    Данные пользователей (users, orders, purchases, logs) распределяются по
+    shards файлам по telegram_id, пул ключей живёт в отдельном файле. У
+    каждого файла своя блокировка записи, поэтому заказы разных
+    пользователей пишутся параллельно.
+
+    Методы совпадают с Database. ID заказов глобальные: в них закодирован
+    номер шарда (local_id * shards + shard), так что callback_data вида
+    paid_{order_id} продолжает работать без изменений.
+    """
+
+    def __init__(self, db_path='bot_database.db', shards=4, **options):
+        """
+        Args:
+            db_path: Базовый путь, файлы будут <имя>.shardN.db и <имя>.keys.db
+            shards: Количество шардов пользовательских данных
+            options: Параметры, передаваемые каждому Database
+                (key_deriver - только файлу ключей)
+        """
+        if shards < 1:
+            raise ValueError("Количество шардов должно быть не меньше 1")
+        base, ext = os.path.splitext(db_path)
+        ext = ext or '.db'
+        key_deriver = options.pop('key_deriver', None)
+        self.db_path = db_path
+        self.shards = [
+            Database(f'{base}.shard{i}{ext}', **options) for i in range(shards)
+        ]
+        self.keys_db = Database(f'{base}.keys{ext}', key_deriver=key_deriver, **options)
+
+    # ============= МАРШРУТИЗАЦИЯ =============
+
+    def shard_for_user(self, telegram_id):
+        """Шард с данными пользователя"""
+        return self.shards[telegram_id % len(self.shards)]
+
+    def _global_order_id(self, shard_index, local_id):
+        return local_id * len(self.shards) + shard_index
+
+    def _split_order_id(self, order_id):
+        """Глобальный ID заказа -> (шард, локальный ID)"""
+        return self.shards[order_id % len(self.shards)], order_id // len(self.shards)
+
+    def _order_to_global(self, shard, order):
+        if order is None:
+            return None
+        order['id'] = self._global_order_id(self.shards.index(shard), order['id'])
+        return order
+
+    def _purchase_to_global(self, shard, purchase):
+        purchase['order_id'] = self._global_order_id(self.shards.index(shard), purchase['order_id'])
+        return purchase
+
+    # ============= ОБСЛУЖИВАНИЕ =============
+
+    def get_databases(self):
+        """Все файлы хранилища"""
+        return [self.keys_db] + self.shards
+
+    def init_db(self):
+        """Инициализация всех файлов"""
+        for database in self.get_databases():
+            database.init_db()
+
+    def migrate(self):
+        return min(database.migrate() for database in self.get_databases())
+
+    def get_connection(self):
+        """Соединение с файлом ключей (для запросов только к keys)"""
+        return self.keys_db.get_connection()
+
+    def close(self):
+        for database in self.get_databases():
+            database.close()
+
+    def flush_logs(self):
+        for database in self.get_databases():
+            database.flush_logs()
+
+    # ============= ПОЛЬЗОВАТЕЛИ =============
+
+    def add_user(self, telegram_id, username):
+        """Добавление пользователя"""
+        return self.shard_for_user(telegram_id).add_user(telegram_id, username)
+
+    def get_user(self, telegram_id):
+        """Получение пользователя"""
+        return self.shard_for_user(telegram_id).get_user(telegram_id)
+
+    # ============= КЛЮЧИ =============
+
+    def add_key(self, key_value):
+        """Добавление ключа"""
+        return self.keys_db.add_key(key_value)
+
+    def add_keys_bulk(self, key_values, chunk_size=1000, progress=None):
+        """Массовое добавление ключей"""
+        return self.keys_db.add_keys_bulk(key_values, chunk_size, progress)
+
+    def insert_keys(self, key_values):
+        """Вставка пачки ключей одной транзакцией"""
+        return self.keys_db.insert_keys(key_values)
+
+    def existing_keys(self, key_values, batch_size=500):
+        """Какие из ключей уже есть в базе"""
+        return self.keys_db.existing_keys(key_values, batch_size)
+
+    def key_filter(self, extra=0, error_rate=0.001):
+        """Фильтр Блума по всем ключам в базе"""
+        return self.keys_db.key_filter(extra, error_rate)
+
+    def get_next_available_key(self):
+        """Получение следующего свободного ключа"""
+        return self.keys_db.get_next_available_key()
+
+    def mark_key_as_used(self, key_id):
+        """Пометить ключ как использованный"""
+        return self.keys_db.mark_key_as_used(key_id)
+
+    def get_available_keys_count(self, include_derived=False):
+        """Количество доступных ключей"""
+        return self.keys_db.get_available_keys_count(include_derived)
+
+    def get_all_keys(self):
+        """Получение всех ключей"""
+        return self.keys_db.get_all_keys()
+
+    def get_keys_page(self, after_id=None, limit=20, status_filter=None, before_id=None):
+        """Страница ключей с keyset-пагинацией"""
+        return self.keys_db.get_keys_page(after_id, limit, status_filter, before_id)
+
+    # ============= ЗАКАЗЫ =============
+
+    def create_order(self, user_id, amount):
+        """Создание заказа"""
+        shard = self.shard_for_user(user_id)
+        local_id = shard.create_order(user_id, amount)
+        return self._global_order_id(self.shards.index(shard), local_id)
+
+    def get_or_create_open_order(self, user_id, amount, max_age=None):
+        """Открытый заказ пользователя или новый"""
+        shard = self.shard_for_user(user_id)
+        local_id = shard.get_or_create_open_order(user_id, amount, max_age)
+        return self._global_order_id(self.shards.index(shard), local_id)
+
+    def get_order(self, order_id):
+        """Получение заказа"""
+        shard, local_id = self._split_order_id(order_id)
+        return self._order_to_global(shard, shard.get_order(local_id))
+
+    def transition_order(self, order_id, status):
+        """Переход заказа в новый статус по ORDER_TRANSITIONS"""
+        shard, local_id = self._split_order_id(order_id)
+        result = shard.transition_order(local_id, status)
+        if not result:
+            return InvalidTransition(order_id, status, result.current_status)
+        return self._order_to_global(shard, result)
+
+    def update_order_status(self, order_id, status):
+        """Обновление статуса заказа (с проверкой перехода)"""
+        return self.transition_order(order_id, status)
+
+    def claim_key_for_order(self, order_id):
+        """
+        Выдача ключа по заказу
+
+        Заказ подтверждается в транзакции своего шарда, ключ резервируется
+        атомарным UPDATE в файле ключей внутри неё. Если транзакция шарда
+        не зафиксировалась, ключ возвращается в пул.
+        """
+        shard, local_id = self._split_order_id(order_id)
+        result = {'status': CLAIM_ERROR, 'order': None, 'key': None}
+        key = None
+        committed = False
+        try:
+            conn = shard.get_connection()
+            keys_conn = self.keys_db.get_connection()
+            with conn:
+                conn.execute('BEGIN IMMEDIATE')
+
+                order = conn.execute(
+                    '''UPDATE orders
+                       SET status = 'confirmed', confirmed_at = CURRENT_TIMESTAMP
+                       WHERE id = ? AND status IN ('created', 'pending')
+                       RETURNING *''',
+                    (local_id,)
+                ).fetchone()
+                if not order:
+                    conn.rollback()
+                    result['status'] = shard._claim_failure_status(conn, local_id)
+                    return result
+
+                with keys_conn:
+                    key = self.keys_db._claim_free_key(keys_conn)
+                if not key:
+                    conn.rollback()
+                    result['status'] = CLAIM_OUT_OF_STOCK
+                    return result
+
+                conn.execute(
+                    'UPDATE orders SET key_id = ? WHERE id = ?',
+                    (key['id'], local_id)
+                )
+                conn.execute(
+                    'INSERT INTO purchases (user_id, order_id, key_id) VALUES (?, ?, ?)',
+                    (order['user_id'], local_id, key['id'])
+                )
+            committed = True
+
+            result['order'] = self._order_to_global(shard, dict(order))
+            result['order']['key_id'] = key['id']
+            result['key'] = self.keys_db._key_row(key)
+            result['status'] = CLAIM_OK
+            shard.log_action(order['user_id'], 'order_confirmed', f'Order ID: {order_id}, Key ID: {key["id"]}')
+        except Exception as e:
+            logger.error(f"Ошибка выдачи ключа по заказу {order_id}: {e}")
+            if key is not None and not committed:
+                self._release_key(key['id'])
+        return result
+
+    def _release_key(self, key_id):
+        try:
+            conn = self.keys_db.get_connection()
+            with conn:
+                conn.execute('UPDATE keys SET is_used = 0 WHERE id = ?', (key_id,))
+        except Exception as e:
+            logger.error(f"Не удалось вернуть ключ {key_id} в пул: {e}")
+
+    def expire_stale_orders(self, created_ttl=3600, pending_ttl=None, batch_size=500):
+        """Перевод брошенных заказов в статус expired на всех шардах"""
+        expired = []
+        for shard in self.shards:
+            expired.extend(
+                self._order_to_global(shard, order)
+                for order in shard.expire_stale_orders(created_ttl, pending_ttl, batch_size)
+            )
+        return expired
+
+    def get_pending_orders(self):
+        """Получение заказов в ожидании со всех шардов"""
+        per_shard = [
+            [self._order_to_global(shard, order) for order in shard.get_pending_orders()]
+            for shard in self.shards
+        ]
+        return list(heapq.merge(
+            *per_shard, key=lambda order: order['created_at'], reverse=True
+        ))
+
+    # ============= ПОКУПКИ =============
+
+    def get_user_purchases(self, user_id):
+        """Получение покупок пользователя"""
+        shard = self.shard_for_user(user_id)
+        conn = shard.get_connection()
+        purchases = [
+            self._purchase_to_global(shard, dict(row))
+            for row in conn.execute(
+                'SELECT * FROM purchases WHERE user_id = ? ORDER BY purchase_date DESC',
+                (user_id,)
+            )
+        ]
+        if not purchases:
+            return []
+
+        key_ids = [purchase['key_id'] for purchase in purchases]
+        placeholders = ', '.join('?' * len(key_ids))
+        keys_conn = self.keys_db.get_connection()
+        key_values = {
+            row['id']: self.keys_db.decode_key(row['key_value'])
+            for row in keys_conn.execute(
+                f'SELECT id, key_value FROM keys WHERE id IN ({placeholders})', key_ids
+            )
+        }
+        # Как и в JOIN у Database: покупки без ключа не возвращаются
+        result = []
+        for purchase in purchases:
+            if purchase['key_id'] in key_values:
+                purchase['key_value'] = key_values[purchase['key_id']]
+                result.append(purchase)
+        return result
+
+    # ============= СТАТИСТИКА =============
+
+    def _merge_statistics(self, per_database):
+        total = {}
+        for stats in per_database:
+            for name, value in stats.items():
+                total[name] = total.get(name, 0) + value
+        return total
+
+    def get_statistics(self):
+        """Статистика, собранная со всех файлов"""
+        return self._merge_statistics(
+            database.get_statistics() for database in self.get_databases()
+        )
+
+    def reconcile_statistics(self):
+        """Пересчёт счётчиков статистики во всех файлах"""
+        return self._merge_statistics(
+            database.reconcile_statistics() for database in self.get_databases()
+        )
+
+    # ============= ВЫГРУЗКА =============
+
+    def iter_rows(self, table, date_from=None, date_to=None, batch_size=1000):
+        """
+        Потоковое чтение строк таблицы со всех шардов
+
+        Строки идут шард за шардом, без общей сортировки.
+        """
+        if table not in EXPORT_TABLES:
+            raise ValueError(f"Неизвестная таблица для выгрузки: {table}")
+        if table == 'keys':
+            yield from self.keys_db.iter_rows(table, date_from, date_to, batch_size)
+            return
+        databases = self.shards if table != 'logs' else [self.keys_db] + self.shards
+        for database in databases:
+            rows = database.iter_rows(table, date_from, date_to, batch_size)
+            if table == 'orders':
+                rows = (self._order_to_global(database, row) for row in rows)
+            elif table == 'purchases':
+                rows = (self._purchase_to_global(database, row) for row in rows)
+            yield from rows
+
+    # ============= ЛОГИ =============
+
+    def log_action(self, user_id, action, details=''):
+        """Логирование действий (системные события - в файл ключей)"""
+        database = self.shard_for_user(user_id) if user_id is not None else self.keys_db
+        return database.log_action(user_id, action, details)
+
+
+def create_database(db_path=None, shards=None, **options):
+    """
+    Создание хранилища по настройкам
+
+    Без шардов (shards=0) возвращает обычный Database с одним файлом,
+    иначе ShardedDatabase. По умолчанию настройки берутся из переменных
+    окружения DATABASE_PATH и DATABASE_SHARDS.
+    """
+    if db_path is None:
+        db_path = os.getenv('DATABASE_PATH', 'bot_database.db')
+    if shards is None:
+        shards = int(os.getenv('DATABASE_SHARDS', '0') or 0)
+    if shards:
+        return ShardedDatabase(db_path, shards, **options)
+    return Database(db_path, **options)
@@ -0,0 +1,48 @@
+import threading
+from collections import OrderedDict
+
+
+class KnownUsersCache:
+    """
+    Ограниченный LRU-набор известных telegram_id
+
+    Если пользователь уже есть в кэше, add_user не обращается к базе вообще.
+    При переполнении вытесняются давно не встречавшиеся пользователи, для
+    них снова будет один INSERT OR IGNORE без записи в лог.
+    """
+
+    def __init__(self, max_size=100000):
+        """
+        Args:
+            max_size: Максимальное количество id в кэше
+        """
+        self.max_size = max_size
+        self._ids = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, telegram_id):
+        with self._lock:
+            if telegram_id in self._ids:
+                self._ids.move_to_end(telegram_id)
+                return True
+            return False
+
+    def __len__(self):
+        return len(self._ids)
+
+    def add(self, telegram_id):
+        """Добавление id в кэш"""
+        with self._lock:
+            self._ids[telegram_id] = None
+            self._ids.move_to_end(telegram_id)
+            while len(self._ids) > self.max_size:
+                self._ids.popitem(last=False)
+
+    def update(self, telegram_ids):
+        """Добавление нескольких id (прогрев)"""
+        for telegram_id in telegram_ids:
+            self.add(telegram_id)
+
+    def clear(self):
+        with self._lock:
+            self._ids.clear()
@@ -0,0 +1,154 @@
+import asyncio
+import hmac
+import logging
+import os
+
+from aiohttp import web
+from aiogram.types import Update
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class WebhookServer:
+    """
+    Приём апдейтов через вебхук на встроенном aiohttp-сервере
+
+    Запрос проверяется по секретному заголовку, апдейт ставится в обработку
+    в фоне, и Telegram сразу получает 200. Одновременно обрабатывается не
+    больше max_in_flight апдейтов: когда лимит исчерпан, ответ на следующий
+    запрос ждёт освобождения места, и Telegram притормаживает доставку.
+    """
+
+    def __init__(self, dp, bot, path='/webhook', secret_token=None, max_in_flight=100, metrics=None):
+        """
+        Args:
+            dp: Dispatcher
+            bot: Bot
+            path: Путь, на который приходят апдейты
+            secret_token: Секрет для заголовка X-Telegram-Bot-Api-Secret-Token
+                (None - без проверки, только для локального режима)
+            max_in_flight: Максимум одновременно обрабатываемых апдейтов
+            metrics: Необязательная функция, возвращающая dict для /health
+                (например, OutboundScheduler.stats)
+        """
+        self.dp = dp
+        self.bot = bot
+        self.path = path
+        self.secret_token = secret_token
+        self.max_in_flight = max_in_flight
+        self.metrics = metrics
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._tasks = set()
+        self.processed = 0
+        self.failed = 0
+
+    @property
+    def in_flight(self):
+        return len(self._tasks)
+
+    def _check_secret(self, request):
+        if not self.secret_token:
+            return True
+        return hmac.compare_digest(request.headers.get(SECRET_HEADER, ''), self.secret_token)
+
+    async def handle(self, request):
+        """Обработчик POST с апдейтом"""
+        if not self._check_secret(request):
+            logger.warning(f"Вебхук: неверный секрет от {request.remote}")
+            return web.Response(status=401)
+        try:
+            update = Update.model_validate(await request.json(), context={'bot': self.bot})
+        except Exception as e:
+            logger.warning(f"Вебхук: некорректный апдейт: {e}")
+            return web.Response(status=400)
+
+        await self._slots.acquire()
+        task = asyncio.create_task(self._process(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return web.Response()
+
+    async def _process(self, update):
+        try:
+            await self.dp.feed_update(self.bot, update)
+            self.processed += 1
+        except Exception as e:
+            self.failed += 1
+            logger.error(f"Ошибка обработки апдейта {update.update_id}: {e}")
+        finally:
+            self._slots.release()
+
+    async def health(self, request):
+        """Состояние сервера для балансировщика и мониторинга"""
+        health = {
+            'in_flight': self.in_flight,
+            'max_in_flight': self.max_in_flight,
+            'processed': self.processed,
+            'failed': self.failed,
+        }
+        if self.metrics is not None:
+            health['outbound'] = self.metrics()
+        return web.json_response(health)
+
+    def app(self):
+        """aiohttp-приложение с маршрутами вебхука"""
+        app = web.Application()
+        app.router.add_post(self.path, self.handle)
+        app.router.add_get('/health', self.health)
+        return app
+
+    async def drain(self, timeout=10):
+        """Ожидание апдейтов, которые ещё в обработке"""
+        if self._tasks:
+            await asyncio.wait(set(self._tasks), timeout=timeout)
+
+    async def serve(self, host='0.0.0.0', port=8080, webhook_url=None,
+                    max_connections=40, drop_pending_updates=False):
+        """
+        Запуск сервера до отмены задачи
+
+        Args:
+            host: Адрес для прослушивания
+            port: Порт
+            webhook_url: Публичный URL вебхука для setWebhook (None - вебхук
+                не регистрируется, апдейты можно слать локально)
+            max_connections: Сколько соединений Telegram может открыть одновременно
+            drop_pending_updates: Сбросить накопившиеся апдейты при регистрации
+        """
+        runner = web.AppRunner(self.app())
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        await self.dp.emit_startup(bot=self.bot)
+        try:
+            if webhook_url:
+                await self.bot.set_webhook(
+                    webhook_url,
+                    secret_token=self.secret_token,
+                    max_connections=max_connections,
+                    allowed_updates=self.dp.resolve_used_update_types(),
+                    drop_pending_updates=drop_pending_updates,
+                )
+                logger.info(f"Вебхук зарегистрирован: {webhook_url}")
+            else:
+                logger.info(f"Локальный режим: апдейты принимаются на http://{host}:{port}{self.path}")
+            # Вебхук не снимается при остановке: за балансировщиком
+            # могут работать другие экземпляры бота
+            await asyncio.Event().wait()
+        finally:
+            await self.drain()
+            await self.dp.emit_shutdown(bot=self.bot)
+            await runner.cleanup()
+            await self.bot.session.close()
+
+
+def webhook_from_env(dp, bot, metrics=None):
+    """Сервер вебхука по настройкам из переменных окружения"""
+    return WebhookServer(
+        dp, bot,
+        path=os.getenv('WEBHOOK_PATH', '/webhook'),
+        secret_token=os.getenv('WEBHOOK_SECRET') or None,
+        max_in_flight=int(os.getenv('WEBHOOK_MAX_IN_FLIGHT', '100')),
+        metrics=metrics,
+    )